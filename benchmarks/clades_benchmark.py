@@ -0,0 +1,55 @@
+"""
+Time the commands which summarise the clades of a treestream on trees of
+increasing size.
+
+Usage: python benchmarks/clades_benchmark.py [TREES [TAXA...]]
+
+For each number of taxa (by default 100, 500 and 2000), TREES random
+BEAST-style trees are generated and parsed, then summarised in turn by
+`phyltr support`, `phyltr clades -a` and `phyltr consensus`.  Only the
+commands are timed, not parsing.
+"""
+import os
+import sys
+import time
+
+from phyltr.commands.consensus import Consensus
+from phyltr.commands.support import Support
+from phyltr.plumbing.sources import ComplexNewickParser
+from phyltr.utils.cladeprob import CladeProbabilities
+
+from parse_benchmark import beast_tree_string
+
+
+def support(trees):
+    list(Support().consume(trees))
+
+
+def clades_ages(trees):
+    # What `phyltr clades -a` does, but writing the report to /dev/null
+    cp = CladeProbabilities()
+    for t in trees:
+        cp.add_tree(t)
+    cp.compute_probabilities()
+    with open(os.devnull, "w") as fp:
+        cp.save_clade_report(fp, age=True)
+
+
+def consensus(trees):
+    list(Consensus().consume(trees))
+
+
+def main(trees=20, *taxa):
+    for taxon_count in taxa or (100, 500, 2000):
+        lines = [beast_tree_string(taxon_count) + "\n" for _ in range(trees)]
+        for label, command in (
+                ("support", support), ("clades -a", clades_ages), ("consensus", consensus)):
+            parsed = list(ComplexNewickParser(backend="native").consume(lines))
+            start = time.perf_counter()
+            command(parsed)
+            rate = len(parsed) / (time.perf_counter() - start)
+            print("%5d taxa  %-10s %8.2f trees/sec" % (taxon_count, label, rate))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""
+Time counting the clades of a treestream with increasing numbers of worker
+processes, as `phyltr clades --jobs N` does.
+
+Usage: python benchmarks/jobs_benchmark.py [TREES [TAXA [JOBS...]]]
+
+TREES random BEAST-style trees of TAXA taxa (by default 1000 of 200) are
+formatted as the Newick lines phyltr commands read, and their clades are
+counted from the lines with each number of jobs (by default 1, 2, 4 and 8).
+The serial run parses the lines in this process, as `phyltr clades` does.
+The clade tables of all runs are checked to be identical.
+"""
+import io
+import sys
+import time
+
+from phyltr.plumbing.sinks import NewickFormatter
+from phyltr.plumbing.sources import ComplexNewickParser, NewickParser
+from phyltr.utils.cladeprob import CladeProbabilities
+
+from parse_benchmark import beast_tree_string
+
+
+def count_clades(lines, jobs):
+    # What `phyltr clades --jobs` does, without printing the report
+    cp = CladeProbabilities()
+    if jobs > 1:
+        cp.add_trees_parallel(lines, jobs)
+    else:
+        for t in NewickParser().consume(lines):
+            cp.add_tree(t)
+    return cp
+
+
+def main(trees=1000, taxa=200, *jobs):
+    out = io.StringIO()
+    NewickFormatter(out).consume(ComplexNewickParser(backend="native").consume(
+        beast_tree_string(taxa) + "\n" for _ in range(trees)))
+    lines = out.getvalue().splitlines(True)
+    tables = []
+    for job_count in jobs or (1, 2, 4, 8):
+        start = time.perf_counter()
+        cp = count_clades(lines, job_count)
+        rate = trees / (time.perf_counter() - start)
+        print("%3d jobs %10.1f trees/sec" % (job_count, rate))
+        tables.append((cp.clade_counts, cp.clade_ages, cp.leaf_heights))
+    assert all(table == tables[0] for table in tables)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,45 @@
+"""
+Compare the parsing speed of the ete3 and native Newick backends.
+
+Usage: python benchmarks/parse_benchmark.py [TAXA [TREES [FEATURES]]]
+
+Random BEAST-style trees with rate and location annotations, plus FEATURES
+further numeric annotations, on every node are generated, then parsed with
+ComplexNewickParser using each backend in turn.
+"""
+import random
+import sys
+import time
+
+from phyltr.plumbing.sources import ComplexNewickParser
+
+
+def beast_tree_string(taxa, features=0):
+    def annotation():
+        extra = "".join(",trait%d=%f" % (i, random.random()) for i in range(features))
+        return "[&rate=%f,location={%f,%f}%s]:%f" % (
+            random.random(), random.random(), random.random(), extra, random.random())
+
+    nodes = ["T%d%s" % (i, annotation()) for i in range(taxa)]
+    while len(nodes) > 1:
+        random.shuffle(nodes)
+        a, b = nodes.pop(), nodes.pop()
+        nodes.append("(%s,%s)%s" % (a, b, annotation()))
+    return nodes[0] + ";"
+
+
+def benchmark(backend, lines):
+    start = time.perf_counter()
+    count = sum(1 for _ in ComplexNewickParser(backend=backend).consume(lines))
+    assert count == len(lines)
+    return count / (time.perf_counter() - start)
+
+
+def main(taxa=100, trees=500, features=0):
+    lines = [beast_tree_string(taxa, features) + "\n" for _ in range(trees)]
+    for backend in ("ete3", "native"):
+        print("%-8s %8.1f trees/sec" % (backend, benchmark(backend, lines)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,52 @@
+"""
+Compare the speed of formatting annotated trees with ete3's write method and
+with the NewickFormatter sink.
+
+Usage: python benchmarks/write_benchmark.py [TAXA [TREES [FEATURES]]]
+
+Random BEAST-style trees, annotated as in parse_benchmark.py, are parsed with
+the native backend and then written out with each formatter in turn.  The
+outputs are checked to be identical.
+"""
+import io
+import sys
+import time
+
+from phyltr.plumbing.sinks import NewickFormatter
+from phyltr.plumbing.sources import ComplexNewickParser
+
+from parse_benchmark import beast_tree_string
+
+
+def ete3_write(trees):
+    out = io.StringIO()
+    feature_names = set()
+    for n in trees[0].traverse():
+        feature_names |= n.features
+    feature_names = sorted(feature_names - {"dist", "name", "support"})
+    for t in trees:
+        out.write(t.write(features=feature_names, format_root_node=True))
+        out.write("\n")
+    return out.getvalue()
+
+
+def phyltr_write(trees):
+    out = io.StringIO()
+    NewickFormatter(out).consume(trees)
+    return out.getvalue()
+
+
+def main(taxa=1000, trees=100, features=0):
+    lines = [beast_tree_string(taxa, features) + "\n" for _ in range(trees)]
+    trees = list(ComplexNewickParser(backend="native").consume(lines))
+    outputs = []
+    for label, write in (("ete3", ete3_write), ("phyltr", phyltr_write)):
+        start = time.perf_counter()
+        outputs.append(write(trees))
+        rate = len(trees) / (time.perf_counter() - start)
+        print("%-8s %8.1f trees/sec" % (label, rate))
+    assert outputs[0] == outputs[1]
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -21,6 +21,7 @@ from textwrap import shorten
 # import all commands:
 from phyltr.commands import *  # noqa: F401, F403
 from phyltr.commands.base import PhyltrCommand
+from phyltr.plumbing.inputs import MappedFileInput
 
 COMMANDS = {cls.__name__.lower(): cls for cls in PhyltrCommand.__subclasses__()}
 
@@ -98,8 +99,7 @@ def build_pipeline(string, source):
             if isinstance(source, str) and os.path.exists(source):
                 # If source is a filename, feed it to the command's default
                 # Source
-                fp = open(source, "r")
-                source = command_obj.init_source().consume(fp)
+                source = command_obj.init_source().consume(MappedFileInput([source]))
             generator = command_obj.consume(source)
         else:
             # Subsequent components in the pipline should use their proceeding
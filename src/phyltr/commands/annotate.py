@@ -3,6 +3,7 @@ import sys
 
 from phyltr.commands.base import PhyltrCommand
 from phyltr.plumbing.sinks import NullSink
+from phyltr.utils.featureschema import FeatureSchema
 from phyltr.utils.misc import dicts_from_csv
 
 
@@ -36,6 +37,8 @@ class Annotate(PhyltrCommand):
     def __init__(self, **kw):
         PhyltrCommand.__init__(self, **kw)
         self.annotations = {}
+        # The features of the trees extracted so far
+        self.schema = FeatureSchema()
 
         if self.opts.extract and (self.opts.filename == "-" or not self.opts.filename):
             # If we're writing an extracted CSV to stdin, we don't want to also
@@ -71,12 +74,13 @@ class Annotate(PhyltrCommand):
             fp = sys.stdout  # pragma: no cover
         else:
             fp = open(self.opts.filename, "a" if n > 1 else "w")
-        features = []
+        nodes = []
         for node in t.traverse():
-            for f in node.features:
-                if f not in ["dist", "support", "name"] and f not in features:
-                    features.append(f)
-        features.sort()
+            self.schema.add_node(node)
+            # Only include the root node or nodes with names
+            if node.name or not node.up:
+                nodes.append(node)
+        features = self.schema.names
         fieldnames = ["name"]
         if self.opts.multiple:
             fieldnames.append("tree_number")
@@ -84,10 +88,7 @@ class Annotate(PhyltrCommand):
         writer = csv.DictWriter(fp, fieldnames=fieldnames)
         if n == 1:
             writer.writeheader()
-        for node in t.traverse():
-            # Only include the root node or nodes with names
-            if not node.name and node.up:
-                continue
+        for node in nodes:
             if any([hasattr(node, f) for f in features]):
                 if not node.name:
                     # Temporarily give the node a name
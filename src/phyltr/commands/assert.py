@@ -1,4 +1,5 @@
 from phyltr.commands.base import PhyltrCommand
+from phyltr.utils.taxonregistry import REGISTRY
 
 
 class Assert(PhyltrCommand):
@@ -10,7 +11,7 @@ class Assert(PhyltrCommand):
         self.taxonset = None
 
     def process_tree(self, t, n):
-        leaves = set(l.name for l in t.get_leaves())
+        leaves = set(REGISTRY.leaf_ids(t))
         if n == 1:
             self.taxonset = leaves
         else:
@@ -1,8 +1,10 @@
-import fileinput
 import shlex
 import sys
 import argparse
+from contextlib import redirect_stdout
 
+from phyltr.plumbing.inputs import MappedFileInput
+from phyltr.plumbing.outputs import open_output
 from phyltr.plumbing.sources import NewickParser
 from phyltr.plumbing.sinks import NewickFormatter
 
@@ -45,6 +47,10 @@ class PhyltrCommand(object):
         )
         for args, kw in cls.__options__:
             cls.__opt_dests.append(res.add_argument(*args, **kw).dest)
+        cls.__opt_dests.append(res.add_argument(
+            '--output-file', dest='output_file', metavar='FILE', default=None,
+            help="File to write the command's output to instead of stdout. Files ending in "
+                 ".gz, .bz2 or .xz are compressed accordingly.").dest)
         return res
 
     @classmethod
@@ -63,14 +69,25 @@ class PhyltrCommand(object):
             sys.stderr.write(str(e))
             return 1
 
-        obj.pre_print()
-
-        raw_source = fileinput.input(getattr(options, 'files', []) + (files or []))
-        in_trees = obj.init_source().consume(raw_source)
-        out_trees = obj.consume(in_trees)
-        obj.init_sink(sys.stdout).consume(out_trees)
-        raw_source.close()
-        obj.post_print()
+        # Everything the command prints goes to the output file, if any
+        out = open_output(options.output_file)
+        try:
+            with redirect_stdout(out):
+                obj.pre_print()
+
+                filenames = getattr(options, 'files', []) + (files or [])
+                raw_source = MappedFileInput(filenames)
+                if filenames or obj.reads_stdin():
+                    in_trees = obj.init_source().consume(raw_source)
+                else:
+                    in_trees = []
+                out_trees = obj.consume(in_trees)
+                obj.init_sink(out).consume(out_trees)
+                raw_source.close()
+                obj.post_print()
+        finally:
+            if out is not sys.stdout:
+                out.close()
         return 0
 
     @classmethod
@@ -87,6 +104,12 @@ class PhyltrCommand(object):
     def init_sink(cls, stream):
         return cls.sink(stream)
 
+    def reads_stdin(self):
+        """
+        Whether a treestream is read from stdin when no files are given.
+        """
+        return True
+
     def pre_print(self):
         pass    # pragma: no cover
 
@@ -1,6 +1,26 @@
+import argparse
+
 from phyltr.commands.base import PhyltrCommand
 from phyltr.plumbing.sources import ComplexNewickParser
 from phyltr.plumbing.sinks import NewickFormatter
+from phyltr.utils.phyltroptparse import jobs_option
+
+
+def tree_range(string):
+    """
+    Parse a START:STOP[:STEP] range of trees into a slice.
+    """
+    bits = string.split(":")
+    try:
+        if len(bits) not in (2, 3):
+            raise ValueError
+        res = slice(*[int(bit) if bit else None for bit in bits])
+        if res.step == 0:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid range '%s', expected START:STOP[:STEP]" % string)
+    return res
 
 
 class Cat(PhyltrCommand):
@@ -27,6 +47,16 @@ The trees may contain trees formatted as a phyltr treestream or a NEXUS file.
                 action="store", dest="subsample", type=int, default=1,
                 help="Frequency at which to subsample trees, i.e. '-s 10' will include only every "
                      "10th tree in the treestream.")),
+        (
+            ('--range',),
+            dict(
+                action="store", dest="range", type=tree_range, default=None,
+                metavar="START:STOP[:STEP]",
+                help="Range of trees to keep from each file, counted from 0 after the burn in "
+                     "and before subsampling, as in a Python slice, e.g. '--range 1000:2000' or "
+                     "'--range=-500:'. "
+                     "Regular files are read by seeking to the kept trees, using the index "
+                     "written by 'phyltr index' if it is up to date.")),
         (
             ('--no-annotations',),
             dict(
@@ -41,10 +71,30 @@ The trees may contain trees formatted as a phyltr treestream or a NEXUS file.
                 help="Print very clean trees with only the leaf names and branching structure "
                      "included, removing branch lengths, clade supports and any other annotations. "
                      "Stronger than, and overrides, --no-annotations.")),
+        (
+            ('--parser',),
+            dict(
+                dest="parser", default="ete3", choices=["ete3", "native"],
+                help="The Newick parser backend to use. 'native' builds trees in a single pass "
+                     "over each tree string and is considerably faster on large or heavily "
+                     "annotated trees.")),
+        jobs_option(
+            'Number of processes to parse trees with. Trees are still output in their '
+            'original order.'),
+        (
+            ('--lazy',),
+            dict(
+                action="store_true", dest="lazy", default=False,
+                help="Only parse trees when a later command in the pipeline needs their "
+                     "structure.  Trees which are never parsed and need no Nexus translation "
+                     "are output exactly as they were read.  Malformed trees cause an error "
+                     "when they are parsed rather than being skipped.")),
     ]
 
     def init_source(self):
-        return ComplexNewickParser(self.opts.burnin, self.opts.subsample)
+        return ComplexNewickParser(
+            self.opts.burnin, self.opts.subsample, backend=self.opts.parser, jobs=self.opts.jobs,
+            lazy=self.opts.lazy, tree_range=self.opts.range)
 
     def init_sink(self, stream):
         return NewickFormatter(
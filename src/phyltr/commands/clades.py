@@ -1,6 +1,10 @@
+import sys
+
 from phyltr.commands.base import PhyltrCommand
+from phyltr.plumbing.sources import NewickStrings
 from phyltr.plumbing.sinks import StringFormatter
 import phyltr.utils.cladeprob
+from phyltr.utils.phyltroptparse import summary_error_option, jobs_option
 
 
 class Clades(PhyltrCommand):
@@ -9,8 +13,22 @@ class Clades(PhyltrCommand):
     in the stream which contain each clade.  The format of the output is
     identical to that produced by the 'phyltr support' command when using the
     '-o' option, and some of the same options are available.
+
+    The clades of a treestream can also be saved to a table file, and the
+    tables of several treestreams, e.g. independent MCMC runs summarised in
+    parallel, merged into one report with
+    'phyltr clades --merge-tables run1.table run2.table'.  Trees are then only
+    read from the files given, so the treestream on stdin is only added to the
+    tables as '-', e.g. 'phyltr cat run3.trees | phyltr clades - --merge-tables
+    run1.table'.
     """
     __options__ = [
+        (
+            ('files',),
+            dict(
+                metavar='FILE', nargs='*',
+                help='Filename to read treestreams from. If no filenames are specified, the '
+                     'treestream will be read from stdin, unless tables are merged.')),
         (
             ('-a', '--ages'),
             dict(
@@ -23,18 +41,62 @@ class Clades(PhyltrCommand):
                 type=float, dest="frequency", default=0.0,
                 help='Minimum clade frequency to include in output (by default all clades '
                      'are included)')),
+        summary_error_option(),
+        jobs_option(
+            'Number of processes to count clades with. Trees are read as strings and '
+            'parsed by the worker processes.'),
+        (
+            ('--save-table',),
+            dict(
+                dest="save_table", metavar="FILE", default=None,
+                help="File to save a table of the clades to, which can be merged with others "
+                     "using --merge-tables")),
+        (
+            ('--merge-tables',),
+            dict(
+                dest="merge_tables", metavar="FILE", nargs="+", default=[],
+                help="Clade tables saved with --save-table to add to the clades of the "
+                     "treestream")),
     ]
 
     sink = StringFormatter
 
     def __init__(self, **kw):
         PhyltrCommand.__init__(self, **kw)
-        self.cp = phyltr.utils.cladeprob.CladeProbabilities()
+        self.cp = phyltr.utils.cladeprob.CladeProbabilities(
+            summary_error=self.opts.summary_error)
+
+    def init_source(self):
+        if self.opts.jobs > 1:
+            return NewickStrings()
+        return PhyltrCommand.init_source(self)
+
+    def reads_stdin(self):
+        return not self.opts.merge_tables
+
+    def consume(self, stream):
+        if self.opts.jobs > 1:
+            self.cp.add_trees_parallel(stream, self.opts.jobs)
+            stream = []
+        for t in PhyltrCommand.consume(self, stream):
+            yield t
 
     def process_tree(self, t, _):
         self.cp.add_tree(t)
 
     def postprocess(self, _):
+        for filename in self.opts.merge_tables:
+            try:
+                table = phyltr.utils.cladeprob.CladeProbabilities.load_table(filename)
+                if self.cp.tree_count:
+                    self.cp.merge(table)
+                else:
+                    # Tables may be merged without any trees, whatever their summary error
+                    self.cp = table
+            except (OSError, ValueError) as e:
+                self.parser().error("can't merge %s: %s" % (filename, e))
+        if self.opts.save_table:
+            self.cp.save_table(self.opts.save_table)
         self.cp.compute_probabilities()
-        self.cp.save_clade_report("/dev/stdout", self.opts.frequency, self.opts.ages)
+        self.cp.save_clade_report(sys.stdout, self.opts.frequency, self.opts.ages)
         return []
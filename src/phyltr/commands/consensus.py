@@ -1,45 +1,73 @@
 import ete3
 
 from phyltr.commands.base import PhyltrCommand
+from phyltr.plumbing.sources import NewickStrings
 import phyltr.utils.cladeprob
-from phyltr.utils.phyltroptparse import VALID_LENGTHS, length_option
+from phyltr.utils.phyltroptparse import length_option, summary_error_option, jobs_option
+from phyltr.utils.taxonregistry import REGISTRY
 
 
 class Consensus(PhyltrCommand):
     """
-    Produce a majority rules consensus tree for the tree stream.
+    Produce a majority rules consensus tree for the tree stream, or one consensus tree for each of
+    several clade frequency thresholds.
     """
     __options__ = [
         (
             ('-f', '--frequency'),
             dict(
-                type=float, dest="frequency", default=0.5,
-                help="Minimum clade frequency to include in the consensus tree.")),
+                type=float, dest="frequency", default=[0.5], nargs='+',
+                help="Minimum clade frequency to include in the consensus tree. Given several "
+                     "frequencies, e.g. '-f 0.5 0.75 0.95 0', one consensus tree is printed for "
+                     "each of them, in the same order, all from the same clade counts.")),
         length_option('The method used to compute branch lengths for the consensus tree.'),
+        summary_error_option(),
+        jobs_option(
+            'Number of processes to count clades with. Trees are read as strings and '
+            'parsed by the worker processes.'),
     ]
 
     def __init__(self, **kw):
         PhyltrCommand.__init__(self, **kw)
-        self.cp = phyltr.utils.cladeprob.CladeProbabilities()
+        frequency = self.opts.frequency
+        self.frequencies = list(frequency) if isinstance(frequency, (list, tuple)) else [frequency]
+        self.cp = phyltr.utils.cladeprob.CladeProbabilities(
+            summary_error=self.opts.summary_error)
+
+    def init_source(self):
+        if self.opts.jobs > 1:
+            return NewickStrings()
+        return PhyltrCommand.init_source(self)
+
+    def consume(self, stream):
+        if self.opts.jobs > 1:
+            self.cp.add_trees_parallel(stream, self.opts.jobs)
+            stream = []
+        for t in PhyltrCommand.consume(self, stream):
+            yield t
 
     def process_tree(self, t, _):
         self.cp.add_tree(t)
 
     def postprocess(self, _):
         self.cp.compute_probabilities()
-        # Build consensus tree
-        t = self.build_consensus_tree()
-        yield t
-
-    def build_consensus_tree(self):
+        # Select the clades of the lowest threshold once.  Clades are accepted
+        # in order of decreasing frequency, so the clades accepted at a higher
+        # threshold are exactly those accepted at the lowest one which are
+        # frequent enough.
+        clades, top = self.consensus_clades(min(self.frequencies))
+        # Build consensus trees
+        for frequency in self.frequencies:
+            yield self.build_consensus_tree(
+                [(p, clade) for p, clade in clades if p >= frequency], top, frequency)
+
+    def consensus_clades(self, frequency):
         # Build a list of all clades in the treestream with frequency above the
-        # requested threshold, sorted by frequency.  Do not include the trivial
-        # clade of all leaves.
-        clades = []
-        for clade, p in self.cp.clade_probs.items():
-            if p >= self.opts.frequency:
-               clades.append((p, set(clade.split())))
-        clades.sort()
+        # requested threshold, sorted by frequency and then size.  Do not
+        # include the trivial clade of all leaves, which is returned separately.
+        clade_size = phyltr.utils.cladeprob.clade_size
+        clades = [(p, clade) for clade, p in self.cp.clade_probs.items() if p >= frequency]
+        clades.sort(key=lambda c: (c[0], clade_size(c[1])))
 
         # Pop the clade with highest probability, which *should* be the clade
         # with support 1.0 containing all leaves
@@ -50,64 +78,83 @@ class Consensus(PhyltrCommand):
         # If our threshold is below 0.5, it is possible that the set of clades
         # we just built contains clades which contradict one another.  Remove
         # these, by removing clades which conflict with higher supported clades
-        clades = self.enforce_consistency(clades)
-
-        # Now sort the surviving clades by size, to make building the consensus
-        # tree easier
-        clades = sorted([(len(clade), p, clade) for p, clade in clades], reverse=True)
-
-        # Start out with a tree in which all leaves are joined in one big polytomy
-        t = ete3.Tree()
-        for l in all_leaves:
-            t.add_child(name=l)
-
-        # Now recursively resolve the polytomy by greedily grouping clades
-        while clades:
-            n, p, clade = clades.pop()
-            # Pluck the children from the root which comprise this clade
-            clade_nodes = [
-                node for node in t.get_children()
-                if set((l.name for l in node.get_leaves())).issubset(set(clade))]
-            if len(clade_nodes) == 1:
-                continue
-            assert clade_nodes
-            for l in clade_nodes:
-                t.remove_child(l)
-            # Reattach them as descendents of a new child
-            child = t.add_child()
-            child.support = p
-            for l in clade_nodes:
-                child.add_child(l)
+        return self.enforce_consistency(clades), (prob, all_leaves)
+
+    def build_consensus_tree(self, clades, top, frequency):
+        # Now build the tree from the bottom up, by sorting the surviving
+        # clades by size, so that the largest clades already placed inside a
+        # clade are its children.  The taxa of each subtree built so far are
+        # joined in a union-find structure, whose roots know the subtree.
+        clade_size = phyltr.utils.cladeprob.clade_size
+        clades = sorted(clades, key=lambda c: clade_size(c[1]))
+        clades.append(top)
+        all_leaves = top[1]
+        taxon_name = REGISTRY.taxon_name
+        joined = {}
+        subtrees = {}
+        for taxon in phyltr.utils.cladeprob.clade_ids(all_leaves):
+            joined[taxon] = taxon
+            subtrees[taxon] = (ete3.TreeNode(name=taxon_name(taxon)), 1 << taxon)
+
+        def find(taxon):
+            while joined[taxon] != taxon:
+                # Path halving
+                joined[taxon] = taxon = joined[joined[taxon]]
+            return taxon
+
+        for p, clade in clades:
+            node = ete3.TreeNode(support=p)
+            root = None
+            rest = clade
+            while rest:
+                # The subtree of the lowest taxon not yet under this node
+                taxon = find((rest & -rest).bit_length() - 1)
+                child, mask = subtrees.pop(taxon)
+                node.add_child(child)
+                rest &= ~mask
+                if root is None:
+                    root = taxon
+                else:
+                    joined[taxon] = root
+            subtrees[root] = (node, clade)
+        t = node
 
         # Check all is right with the world
         for n in t.traverse():
             assert len(n.get_children()) != 1
-            assert n.support >= self.opts.frequency
+            assert n.support >= frequency
             if n.is_leaf():
                 assert n.name
 
         # Add age annotations
-        cache = t.get_cached_content()
+        masks = phyltr.utils.cladeprob.clade_masks(t)
+        # Heights of the clades below the current one, i.e. the distances to
+        # their farthest leaves with the branch lengths set so far
+        heights = {}
         for clade in t.traverse("postorder"):
-            clade_key = " ".join(sorted([l.name for l in cache[clade]]))
-            if not clade.is_leaf():
+            clade_key = masks[clade]
+            if clade.is_leaf():
+                heights[clade] = 0.0
+            else:
                 # Compute age statistics and annotate tree
                 ages = self.cp.clade_ages[clade_key]
                 phyltr.utils.cladeprob.add_mean_median_hpd(clade, ages, 'age_')
 
                 # Choose the canonical age for this clade
-                clade_age = VALID_LENGTHS[self.opts.lengths](ages)
+                clade_age = phyltr.utils.cladeprob.summary_statistic(ages, self.opts.lengths)
                 # Set branch lengths accordingly
                 for child in clade.get_children():
-                    _, child_height = child.get_farthest_leaf()
-                    child.dist = clade_age - child_height
+                    child.dist = clade_age - heights[child]
+                heights[clade] = max(child.dist + heights[child] for child in clade.get_children())
 
             for f in self.cp.clade_attributes:
-                phyltr.utils.cladeprob.add_mean_median_hpd(
-                    clade, self.cp.clade_attributes[f][clade_key], prefix=f + '_')
+                values = self.cp.clade_attributes[f].get(clade_key)
+                # Non-numeric annotations, e.g. BEAST vectors, have no values
+                if values:
+                    phyltr.utils.cladeprob.add_mean_median_hpd(clade, values, prefix=f + '_')
 
         # Correct leaf heights
-        for leaf in cache[t]:
+        for leaf in t.iter_leaves():
             # Choose the canonical height for this leaf
             # HUOM!  At first glance this code may look "backward" with regard to max and min.
             # But note that maximising/minimising the height of a leaf above the "contemporaneous"
@@ -116,62 +163,64 @@ class Consensus(PhyltrCommand):
             # branch length and therefore *minimum* leaf height (leaf height being the thing we
             # actually keep track of, because it's what people typically calibrate on).
             if self.opts.lengths == 'max':
-                func = min
+                statistic = 'min'
             elif self.opts.lengths == 'min':
-                func = max
+                statistic = 'max'
             else:
-                func = VALID_LENGTHS[self.opts.lengths]
-            leaf.dist -= func(self.cp.leaf_heights[leaf.name])
+                statistic = self.opts.lengths
+            leaf.dist -= phyltr.utils.cladeprob.summary_statistic(
+                self.cp.leaf_heights[leaf.name], statistic)
             #assert leaf.dist >= 0
         # Done!
         return t
 
     def enforce_consistency(self, clades):
         # We don't need to worry about this if we only have clades
-        # that are supported at 0.5 or above, as these are
-        # guaranteed to be consistent
-        if self.opts.frequency >= 0.5:
+        # that are supported above 0.5, as these are guaranteed to be
+        # consistent.  Two clades supported by exactly half the trees
+        # may still conflict.
+        if min(self.frequencies) > 0.5:
             return clades
 
-        # First, find the index of the first clade which is potentially
-        # problematic
-        n = -1
-        for n, (p, c) in enumerate(clades):
-            if p < 0.5:
-                break
-
-        # Now compare the first potentially problematic clade to all
-        # previous (i.e. more highly supported) clades and discard it
-        # if it conflicts with any of them.  Once we've found a clade
-        # compatible with all previous clades, iterate down to the next
-        # least supported clade and compare it to all previous clades,
-        # including the one we just accepted.  Rinse, repeat.
-        #
-        # This is not terribly clear or Pythonic code.
-        # If you can see how to make it better without sacrificing
-        # speed or correctness, feel free!
-        while True:
-            accepted = clades[0:n]
-            dubious = clades[n:]
-            if not dubious:
-                break
-            for p, susp in dubious:
-                for q, good in accepted:
-                    if not test_clade_compat(good, susp):
-                        clades.remove((p, susp))
-                        break
-                else:
-                    n += 1
+        # Accept clades greedily, in order of decreasing support, if they
+        # are compatible with all the clades accepted before them.  The
+        # accepted clades form a tree, kept as the parent of each clade's
+        # bitmask and the smallest accepted clade containing each taxon,
+        # with the clade of all leaves as the root, represented by -1 (all
+        # bits set).  A clade is compatible if every child of the smallest
+        # accepted clade containing it is either inside it or disjoint from
+        # it, which is checked by climbing the tree from its taxa.
+        root = -1
+        parents = {}
+        smallest = {}
+        accepted = []
+        for p, clade in clades:
+            taxon = (clade & -clade).bit_length() - 1
+            parent = smallest.get(taxon, root)
+            while parent & clade != clade:
+                parent = parents[parent]
+            inside = []
+            rest = clade
+            while rest:
+                taxon = (rest & -rest).bit_length() - 1
+                child = smallest.get(taxon, root)
+                if child == parent:
+                    # A taxon directly below parent
+                    rest &= rest - 1
+                    continue
+                while parents[child] != parent:
+                    child = parents[child]
+                if child & ~clade:
                     break
-
-        return clades
-
-
-def test_clade_compat(good, susp):
-    good = set(good)
-    susp = set(susp)
-    if len(good.intersection(susp)) == 0:
-        return True
-    elif good.issubset(susp) or susp.issubset(good):
-        return True
-    return False
+                inside.append(child)
+                rest &= ~child
+            else:
+                accepted.append((p, clade))
+                parents[clade] = parent
+                direct = clade
+                for child in inside:
+                    parents[child] = clade
+                    direct &= ~child
+                for taxon in phyltr.utils.cladeprob.clade_ids(direct):
+                    smallest[taxon] = clade
+        return accepted
@@ -1,6 +1,7 @@
 from phyltr.commands.base import PhyltrCommand
 from phyltr.utils.phyltroptparse import TAXA_FILE_OPTIONS
 from phyltr.utils.misc import read_taxa
+from phyltr.utils.taxonregistry import REGISTRY
 
 
 class Grep(PhyltrCommand):
@@ -32,10 +33,13 @@ class Grep(PhyltrCommand):
         self.opts.taxa = set(self.opts.taxa)
         if len(self.opts.taxa) == 1:
             raise ValueError("Must specify more than one taxon!")
+        self.taxon_ids = REGISTRY.taxon_ids(self.opts.taxa)
 
     def process_tree(self, t, _):
-        clade_leaves = [l for l in t.get_leaves() if l.name in self.opts.taxa]
+        clade_leaves = [l for l in t.iter_leaves() if REGISTRY.leaf_id(l) in self.taxon_ids]
         mrca = t.get_common_ancestor(clade_leaves)
-        is_mono = set(mrca.get_leaves()) == set(clade_leaves)
+        # The clade's leaves are all below the MRCA, so it is monophyletic if
+        # there are no others
+        is_mono = len(mrca) == len(clade_leaves)
         if (is_mono and not self.opts.inverse) or (not is_mono and self.opts.inverse):
             return t
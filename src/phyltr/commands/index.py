@@ -0,0 +1,30 @@
+from phyltr.commands.base import PhyltrCommand
+from phyltr.plumbing.inputs import MappedFileInput
+from phyltr.plumbing.sinks import StringFormatter
+from phyltr.plumbing.treeindex import TreeIndex
+
+
+class Index(PhyltrCommand):
+    """
+    Index the trees in the specified files, so that cat can seek straight to them.
+The byte offsets of the trees in each file, their number, whether the file is NEXUS and its
+translate block are saved to FILE.phyltr-index.  The index is used by cat for burn in and
+--range for as long as the file's size and modification time do not change.
+    """
+    __options__ = [
+        (
+            ('files',),
+            dict(metavar='FILE', nargs='+', help='Tree files to index.')),
+    ]
+    sink = StringFormatter
+
+    def consume(self, stream):
+        # The trees are never parsed, so the treestream is ignored
+        files = MappedFileInput(self.opts.files)
+        for fp in files.binary_files():
+            filename = files.filename()
+            if filename == "-":
+                raise ValueError("Only regular files can be indexed")
+            index = TreeIndex.scan(fp)
+            index.save(filename)
+            yield "%s: %d trees" % (filename, len(index))
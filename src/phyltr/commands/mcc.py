@@ -0,0 +1,78 @@
+from phyltr.commands.base import PhyltrCommand
+from phyltr.plumbing.sources import NewickStrings, RereadableNewickStrings
+import phyltr.utils.cladeprob
+from phyltr.utils.phyltroptparse import summary_error_option, jobs_option
+
+
+class Mcc(PhyltrCommand):
+    """
+    Print the maximum clade credibility tree of the treestream, i.e. the tree with the highest
+    product of clade credibilities, annotated with clade supports and ages.
+
+    Clades are counted on a first pass over the treestream, without keeping the trees, and the
+    trees are scored on a second pass, keeping only the best one.  Regular files are read twice,
+    anything else, e.g. stdin, is copied to a temporary file on the first pass.
+    """
+    __options__ = [
+        (
+            ('files',),
+            dict(
+                metavar='FILE', nargs='*',
+                help='Filename to read treestreams from. If no filenames are specified, the '
+                     'treestream will be read from stdin.')),
+        summary_error_option(),
+        jobs_option(
+            'Number of processes to count clades with. Trees are read as strings and '
+            'parsed by the worker processes.'),
+    ]
+
+    def __init__(self, **kw):
+        PhyltrCommand.__init__(self, **kw)
+        self.cp = phyltr.utils.cladeprob.CladeProbabilities(
+            summary_error=self.opts.summary_error)
+        self.input = None
+
+    def init_source(self):
+        self.input = RereadableNewickStrings()
+        return self.input
+
+    def consume(self, stream):
+        if self.input is None:
+            # Trees passed in directly, rather than read by our own source
+            stream = self.init_source().consume(stream)
+        try:
+            if self.opts.jobs > 1:
+                self.cp.add_trees_parallel(stream, self.opts.jobs)
+            else:
+                for t in NewickStrings.trees(stream):
+                    self.cp.add_tree(t)
+            if not self.cp.tree_count:
+                return
+            self.cp.compute_probabilities()
+
+            # Only the best tree so far is kept.  Ties go to the first tree,
+            # as with 'phyltr support --sort'.
+            best, best_prob = None, None
+            for t in NewickStrings.trees(self.input.reread()):
+                prob = self.cp.get_tree_prob(t)
+                if best is None or prob > best_prob:
+                    best, best_prob = t, prob
+        finally:
+            self.input.close()
+        yield self.annotate_tree(best)
+
+    def annotate_tree(self, t):
+        self.cp.annotate_tree(t)
+        masks = phyltr.utils.cladeprob.clade_masks(t)
+        for node in t.traverse():
+            clade = masks[node]
+            if node._children:
+                ages = self.cp.clade_ages.get(clade)
+                if ages:
+                    phyltr.utils.cladeprob.add_mean_median_hpd(node, ages, 'age_')
+            for f in self.cp.clade_attributes:
+                values = self.cp.clade_attributes[f].get(clade)
+                # Non-numeric annotations, e.g. BEAST vectors, have no values
+                if values:
+                    phyltr.utils.cladeprob.add_mean_median_hpd(node, values, prefix=f + '_')
+        return t
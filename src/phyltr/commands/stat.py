@@ -1,6 +1,6 @@
 from phyltr.commands.base import PhyltrCommand
 from phyltr.plumbing.sinks import NullSink
-from phyltr.utils.topouniq import are_same_topology
+from phyltr.utils.topouniq import topology_key
 
 
 class Stat(PhyltrCommand):
@@ -14,7 +14,7 @@ class Stat(PhyltrCommand):
         self.tree_count = 0
         self.taxa_count = 0
         self.ultrametric = True
-        self.topologically_unique_trees = []
+        self.topologies = set()
         self.tree_ages = []
 
     def process_tree(self, t, n):
@@ -25,21 +25,14 @@ class Stat(PhyltrCommand):
         self.tree_ages.append(t.get_farthest_leaf()[1])
         if abs(max(leave_ages) - min(leave_ages)) > max(leave_ages) / 1000.0:
             self.ultrametric = False
+        self.topologies.add(topology_key(t))
         # Stuff we only do to the first tree...
         if n == 1:
             self.taxa_count = len(leaves)
-            self.topologically_unique_trees.append(t)
-        # Stuff we only do to trees *other* than the first...
-        else:
-            for u in self.topologically_unique_trees:
-                if are_same_topology(t, u):
-                    break
-            else:
-                self.topologically_unique_trees.append(t)
         return t
 
     def postprocess(self, tree_count):
-        self.topology_count = len(self.topologically_unique_trees)
+        self.topology_count = len(self.topologies)
         self.min_tree_height = min(self.tree_ages)
         self.max_tree_height = max(self.tree_ages)
         self.mean_tree_height = sum(self.tree_ages) / tree_count
@@ -1,5 +1,7 @@
 from phyltr.commands.base import PhyltrCommand
+from phyltr.plumbing.sources import NewickStrings
 import phyltr.utils.cladeprob
+from phyltr.utils.phyltroptparse import summary_error_option, jobs_option
 
 
 class Support(PhyltrCommand):
@@ -31,12 +33,37 @@ class Support(PhyltrCommand):
                 action="store_true", dest="sort", default=False,
                 help='Reorder tree stream to print trees in order from highest to lowest product '
                      'of clade credibilities.')),
+        summary_error_option(),
+        jobs_option(
+            'Number of processes to count clades with. Trees are read as strings and '
+            'parsed by the worker processes.'),
     ]
 
     def __init__(self, **kw):
         PhyltrCommand.__init__(self, **kw)
         self.trees = []
-        self.cp = phyltr.utils.cladeprob.CladeProbabilities()
+        self.cp = phyltr.utils.cladeprob.CladeProbabilities(
+            summary_error=self.opts.summary_error)
+
+    def init_source(self):
+        if self.opts.jobs > 1:
+            return NewickStrings()
+        return PhyltrCommand.init_source(self)
+
+    def consume(self, stream):
+        if self.opts.jobs > 1:
+            # Keep the trees to annotate, and only parse them once the clades
+            # have been counted
+            self.cp.add_trees_parallel(self.keep_trees(stream), self.opts.jobs)
+            self.trees = list(NewickStrings.trees(self.trees))
+            stream = []
+        for t in PhyltrCommand.consume(self, stream):
+            yield t
+
+    def keep_trees(self, stream):
+        for t in stream:
+            self.trees.append(t)
+            yield t
 
     def process_tree(self, t, _):
         self.trees.append(t)
@@ -48,7 +75,8 @@ class Support(PhyltrCommand):
 
         # Save clade probabilities
         if self.opts.filename:
-            self.cp.save_clade_report(self.opts.filename, self.opts.frequency, self.opts.age)
+            with open(self.opts.filename, "w") as fp:
+                self.cp.save_clade_report(fp, self.opts.frequency, self.opts.age)
 
         # Annotate trees
         for t in self.trees:
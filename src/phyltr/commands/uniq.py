@@ -1,7 +1,7 @@
 import os
 
 from phyltr.commands.base import PhyltrCommand
-from phyltr.utils.topouniq import are_same_topology
+from phyltr.utils.topouniq import topology_key
 from phyltr.utils.phyltroptparse import VALID_LENGTHS, length_option
 from phyltr.utils.cladeprob import add_mean_median_hpd
 
@@ -51,17 +51,17 @@ class Uniq(PhyltrCommand):
 
     def __init__(self, **kw):
         PhyltrCommand.__init__(self, **kw)
+        # The trees of each topology, keyed by topology_key, in the order the
+        # topologies are first seen
         self.topologies = {}
 
     def process_tree(self, t, _):
-        # Compare this tree to all topology exemplars.  If we find a match,
-        # add it to the record and move on to the next tree.
-        for exemplar in self.topologies:
-            if are_same_topology(t, exemplar):
-                self.topologies[exemplar].append(t)
-                break
+        key = topology_key(t)
+        trees = self.topologies.get(key)
+        if trees is None:
+            self.topologies[key] = [t]
         else:
-            self.topologies[t] = [t]
+            trees.append(t)
         return None
 
     def postprocess(self, tree_count):
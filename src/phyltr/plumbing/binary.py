@@ -0,0 +1,223 @@
+"""
+A compact binary treestream format for pipes between phyltr processes.
+
+In a pipeline like `phyltr cat | phyltr prune | phyltr uniq`, formatting trees
+as Newick and parsing them again in the next process takes most of the CPU
+time.  When the environment variable PHYLTR_BINARY is set, commands whose
+trees are written to a pipe use this format instead, and the sources in
+`phyltr.plumbing.sources` recognise it by its magic header.
+
+A stream is the magic header followed by records, each a kind byte, a payload
+length and the payload.  NAMES records add taxon names to a table shared by
+the rest of the stream, so that each name is sent only once.  TREE records
+hold one tree in preorder: parent indices, name ids, branch lengths, supports
+and one typed column per extra feature.  Arrays use the native byte order,
+as the format is only meant for pipes on one machine.
+"""
+import os
+import stat
+import struct
+from array import array
+
+from phyltr.plumbing.parallel import build_nodes
+from phyltr.plumbing.treeindex import ENCODING
+from phyltr.utils.featureschema import STANDARD_FEATURES
+
+MAGIC = b"\x00PHYLTR-TREES\x01\n"
+ENV_VARIABLE = "PHYLTR_BINARY"
+
+NAMES, TREE = b"N", b"T"
+NO_NAME = -1
+
+_RECORD = struct.Struct("<cI")
+# Number of nodes and number of feature columns
+_TREE_HEADER = struct.Struct("<II")
+# Length of the feature name, type code, number of values, length of the data
+_COLUMN_HEADER = struct.Struct("<HcII")
+_INT_SIZE = array("i").itemsize
+
+
+def use_binary(out):
+    """
+    Return whether trees written to the text stream out should use the binary
+    format: only if this has been opted into by setting PHYLTR_BINARY, and only
+    if out is a pipe, presumably to another phyltr command.
+    """
+    if not os.environ.get(ENV_VARIABLE):
+        return False
+    try:
+        return stat.S_ISFIFO(os.fstat(out.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def is_binary(fp):
+    """
+    Return whether a binary file-like object, such as those yielded by
+    MappedFileInput.binary_files, starts with the magic header.  Nothing is
+    consumed.
+    """
+    if hasattr(fp, "peek"):
+        return fp.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    position = fp.tell()
+    header = fp.read(len(MAGIC))
+    fp.seek(position)
+    return header == MAGIC
+
+
+def _encode_column(values):
+    if all(type(value) is float for value in values):
+        return b"d", array("d", values).tobytes()
+    if all(type(value) is int for value in values):
+        return b"q", array("q", values).tobytes()
+    # Any other values are sent as the strings they would be written as in
+    # Newick.  Nothing but numbers and strings is ever decoded, so reading a
+    # stream from an untrusted source is as safe as reading Newick.
+    values = [value if type(value) is str else str(value) for value in values]
+    joined = "\0".join(values)
+    if joined.count("\0") != len(values) - 1:
+        raise ValueError("Feature values containing NUL characters cannot be written")
+    return b"s", joined.encode(ENCODING)
+
+
+def _decode_column(code, data):
+    if code in (b"d", b"q"):
+        values = array(code.decode())
+        values.frombytes(data)
+        return values.tolist()
+    if code == b"s":
+        return bytes(data).decode(ENCODING).split("\0")
+    raise ValueError("Unknown feature column type %r in binary treestream" % code)
+
+
+class BinaryFormatter(object):
+
+    def __init__(self, out):
+        """
+        :param out: A file-like object opened in binary mode
+        """
+        self.out = out
+        self.names = {}
+
+    def consume(self, stream):
+        self.out.write(MAGIC)
+        for t in stream:
+            self.write_tree(t)
+        self.out.flush()
+
+    def write_record(self, kind, payload):
+        self.out.write(_RECORD.pack(kind, len(payload)))
+        self.out.write(payload)
+
+    def write_tree(self, tree):
+        parents, ids, dists, supports = array("i"), array("i"), array("d"), array("d")
+        columns, new_names, index = {}, [], {}
+        for n, node in enumerate(tree.traverse("preorder")):
+            index[node] = n
+            parents.append(index[node._up] if n else -1)
+            name = node.name
+            if name:
+                name_id = self.names.get(name)
+                if name_id is None:
+                    name_id = self.names[name] = len(self.names)
+                    new_names.append(name)
+                ids.append(name_id)
+            else:
+                ids.append(NO_NAME)
+            dists.append(node._dist)
+            supports.append(node._support)
+            if len(node.features) > 3:
+                for feature in node.features:
+                    if feature not in STANDARD_FEATURES:
+                        column = columns.get(feature)
+                        if column is None:
+                            column = columns[feature] = (array("i"), [])
+                        column[0].append(n)
+                        column[1].append(getattr(node, feature))
+        if new_names:
+            self.write_record(NAMES, "\0".join(new_names).encode(ENCODING))
+
+        parts = [
+            _TREE_HEADER.pack(len(parents), len(columns)),
+            parents.tobytes(),
+            ids.tobytes(),
+            dists.tobytes(),
+            supports.tobytes(),
+        ]
+        for feature, (nodes, values) in sorted(columns.items()):
+            feature = feature.encode(ENCODING)
+            code, data = _encode_column(values)
+            parts.append(_COLUMN_HEADER.pack(len(feature), code, len(values), len(data)))
+            parts.extend([feature, nodes.tobytes(), data])
+        self.write_record(TREE, b"".join(parts))
+
+
+class BinaryTreeReader(object):
+    """
+    Reads the trees of one binary treestream.
+    """
+
+    def __init__(self):
+        self.names = []
+
+    def records(self, fp):
+        """
+        Yield the payloads of the TREE records of a stream, adding the names of
+        its NAMES records to `self.names` as they are reached.
+
+        :param fp: A file-like object opened in binary mode, positioned at the
+            magic header
+        """
+        fp.read(len(MAGIC))
+        while True:
+            header = fp.read(_RECORD.size)
+            if not header:
+                return
+            kind, size = _RECORD.unpack(header)
+            payload = fp.read(size)
+            if kind == NAMES:
+                self.names.extend(payload.decode(ENCODING).split("\0"))
+            elif kind == TREE:
+                yield payload
+
+    def trees(self, fp):
+        for record in self.records(fp):
+            yield read_tree(record, self.names)
+
+
+def read_tree(record, names):
+    """
+    Build a tree from the payload of a TREE record.
+
+    :param names: The name table of the stream, at least up to this record
+    """
+    payload = memoryview(record)
+    count, column_count = _TREE_HEADER.unpack_from(payload)
+    offset = _TREE_HEADER.size
+    arrays = []
+    for code in "iidd":
+        values = array(code)
+        end = offset + values.itemsize * count
+        values.frombytes(payload[offset:end])
+        arrays.append(values)
+        offset = end
+    parents, ids, dists, supports = arrays
+    nodes = build_nodes(
+        parents, [names[name_id] if name_id != NO_NAME else "" for name_id in ids],
+        dists, supports)
+
+    for _ in range(column_count):
+        length, code, values_count, size = _COLUMN_HEADER.unpack_from(payload, offset)
+        offset += _COLUMN_HEADER.size
+        feature = bytes(payload[offset:offset + length]).decode(ENCODING)
+        offset += length
+        indices = array("i")
+        indices.frombytes(payload[offset:offset + _INT_SIZE * values_count])
+        offset += _INT_SIZE * values_count
+        values = _decode_column(code, payload[offset:offset + size])
+        offset += size
+        for i, value in zip(indices, values):
+            node = nodes[i]
+            setattr(node, feature, value)
+            node.features.add(feature)
+    return nodes[0]
@@ -0,0 +1,156 @@
+import bz2
+import gzip
+import lzma
+import mmap
+import sys
+
+from phyltr.plumbing.treeindex import ENCODING
+
+# The magic bytes at the start of compressed files, and how to open them
+COMPRESSION_FORMATS = [
+    (b"\x1f\x8b", gzip.open),
+    (b"BZh", bz2.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+]
+
+
+def get_decompressor(magic):
+    """
+    Return the function which opens files starting with the given bytes for
+    streaming decompression, or None if they are not compressed.
+    """
+    for prefix, open_ in COMPRESSION_FORMATS:
+        if magic.startswith(prefix):
+            return open_
+    return None
+
+
+class TextStdin(object):
+    """
+    The binary file-like interface of MappedFileInput.binary_files for a text
+    stream with no binary buffer, e.g. an io.StringIO put in place of stdin
+    when phyltr is embedded or tested.  Lines are encoded as they are read,
+    and text streams are never compressed or binary treestreams.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    def readline(self):
+        return self.text.readline().encode(ENCODING)
+
+    def peek(self, size=0):
+        return b""
+
+    def tell(self):
+        raise OSError("Text streams have no byte positions")
+
+    def close(self):
+        pass
+
+
+class MappedFileInput(object):
+    """
+    A replacement for `fileinput.input` which memory maps regular files.
+    Files compressed with gzip, bzip2 or xz, including stdin, are detected by
+    their magic bytes and decompressed as they are read.
+
+    Iterating over it yields decoded lines, like `fileinput` does, for sources
+    which need every line.  Sources which can select lines on raw bytes, like
+    `ComplexNewickParser`, should instead iterate over `binary_files()` and
+    decode only what they keep.
+    """
+
+    def __init__(self, files=None):
+        self.files = list(files or []) or ["-"]
+        self._filename = None
+        self._buffer = None
+        self._filelineno = 0
+        self._skip = False
+        self._seekable = False
+
+    def binary_files(self):
+        """
+        Yield each input in turn as a binary file-like object: an mmap for
+        regular files, the binary buffer of stdin for "-", or a decompressing
+        file object for either if they are compressed.  A text stdin without a
+        binary buffer is yielded as a TextStdin.
+        """
+        for filename in self.files:
+            self._filename = filename
+            self._filelineno = 0
+            self._skip = False
+            if filename == "-":
+                stdin = getattr(sys.stdin, "buffer", None)
+                if stdin is None:
+                    self._buffer = TextStdin(sys.stdin)
+                else:
+                    decompress = get_decompressor(stdin.peek(6)) if hasattr(stdin, "peek") else None
+                    self._buffer = decompress(stdin) if decompress else stdin
+                self._seekable = False
+                yield self._buffer
+                continue
+            with open(filename, "rb") as fp:
+                decompress = get_decompressor(fp.read(6))
+                if decompress is None:
+                    try:
+                        self._buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    except ValueError:
+                        # Empty files cannot be mapped, and contain no trees
+                        continue
+            if decompress is not None:
+                self._buffer = decompress(filename, "rb")
+            self._seekable = True
+            try:
+                yield self._buffer
+            finally:
+                self._buffer.close()
+                self._buffer = None
+
+    def __iter__(self):
+        for fp in self.binary_files():
+            for line in self.lines(fp):
+                yield line
+
+    def lines(self, fp):
+        """
+        Yield the decoded lines of one of the files from binary_files.
+        """
+        if isinstance(fp, TextStdin):
+            # Already text, so no need to encode and decode the lines
+            for line in iter(fp.text.readline, ""):
+                if self._skip:
+                    break
+                self._filelineno += 1
+                yield line
+            return
+        for line in iter(fp.readline, b""):
+            if self._skip:
+                break
+            self._filelineno += 1
+            line = line.decode(ENCODING)
+            if line.endswith("\r\n"):
+                # Match the newline translation of files opened as text
+                line = line[:-2] + "\n"
+            yield line
+
+    def filename(self):
+        return self._filename
+
+    def seekable(self):
+        """
+        Return whether the current file can be re-read by offset.  Compressed
+        files can, at the cost of decompressing them again.
+        """
+        return self._seekable
+
+    def isfirstline(self):
+        return self._filelineno == 1
+
+    def nextfile(self):
+        self._skip = True
+
+    def close(self):
+        if self._buffer is not None and self._filename != "-":
+            self._buffer.close()
+            self._buffer = None
@@ -0,0 +1,65 @@
+"""
+Trees which are only parsed once their structure is needed.
+
+Many pipeline stages never look inside the trees they pass on, e.g. `phyltr
+cat -s 10`.  A LazyTree holds the Newick string it was read from and parses it
+the first time any attribute of the tree is read or set.  From then on it is an
+ordinary ete3 tree.  Until then, a sink can write the original string back
+instead of formatting the tree.
+"""
+from ete3 import TreeNode
+
+
+class LazyTree(TreeNode):
+
+    def __init__(self, newick, parse, verbatim=True):
+        """
+        :param newick: The Newick string of the tree
+        :param parse: A function which parses newick into an ete3 tree
+        :param verbatim: Whether newick may be written back unchanged, e.g.
+            False if its labels still need to be translated
+        """
+        # TreeNode.__init__ is deliberately not called: the attributes of a
+        # node are taken from the parsed tree instead.
+        self._lazy_newick = newick
+        self._lazy_parse = parse
+        self._lazy_verbatim = verbatim
+
+    def __getattr__(self, name):
+        # Only called for attributes which have not been set, i.e. before the
+        # tree is parsed
+        if name.startswith("__") or name.startswith("_lazy_") or self._lazy_newick is None:
+            raise AttributeError(name)
+        self.parse()
+        return getattr(self, name)
+
+    def __setattr__(self, name, value):
+        if not name.startswith("_lazy_"):
+            self.parse()
+        object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        if self._lazy_newick is not None:
+            return "Unparsed tree (%s)" % hex(self.__hash__())
+        return TreeNode.__repr__(self)
+
+    def parse(self):
+        """
+        Parse the tree string, if that has not happened yet, and take over the
+        nodes of the resulting tree.
+        """
+        if self._lazy_newick is None:
+            return
+        root = self._lazy_parse(self._lazy_newick)
+        self.__dict__.update(root.__dict__)
+        for child in self._children:
+            child._up = self
+        self._lazy_newick = None
+        self._lazy_parse = None
+
+    def verbatim(self):
+        """
+        Return the original Newick string if the tree has never been parsed
+        and needs no changes to be written, or None otherwise.
+        """
+        return self._lazy_newick if self._lazy_verbatim else None
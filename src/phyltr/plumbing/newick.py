@@ -0,0 +1,309 @@
+"""
+A single-pass Newick/NHX reader which builds ete3 trees directly, and a writer
+which formats them without going through ete3.
+
+ete3's own reader matches a regular expression against every node and
+requires BEAST-style comments to be rewritten into NHX beforehand.  The reader
+in this module splits the tree string once on its structural characters and
+walks the resulting pieces, creating nodes and attaching names, branch lengths,
+supports and annotations as it goes.
+
+ete3's writer formats every node through a generic, format-table driven
+function.  NewickWriter walks the tree with an explicit stack instead, using
+label formatting specialised for the few formats phyltr writes, and produces
+the same output byte for byte.
+"""
+import re
+
+from ete3 import TreeNode
+from ete3.parser.newick import ITERABLE_TYPES, NewickError
+
+
+# Split a tree string into comments, quoted labels and structural characters.
+# Everything in between (names, numbers) ends up in the odd-numbered pieces.
+_PIECES_REGEX = re.compile(r"(\[[^\]]*\]|'(?:[^']|'')*'|[(),:;])")
+# BEAST vector annotations, e.g. {12.3,4.56}
+_VECTOR_REGEX = re.compile(r"\{[^}]*\}")
+# Characters which ete3 replaces with underscores in names and feature values
+_ILLEGAL_REGEX = re.compile(r"[:;(),\[\]\t\n\r=]")
+_MISSING = object()
+
+
+def _new_node(parent):
+    node = TreeNode()
+    node._up = parent
+    parent._children.append(node)
+    return node
+
+
+def _parse_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        # BEAST occasionally writes a dangling exponent marker, e.g. "0.5E"
+        return float(text.rstrip("eE"))
+
+
+def _join_vector(match):
+    return match.group().replace(",", "|")
+
+
+def _split_beast_annotation(annotation):
+    """
+    Split the body of a BEAST comment on commas, keeping the elements of
+    vector annotations (comma-separated elements inside {}s) together.
+    """
+    if "{" in annotation:
+        annotation = _VECTOR_REGEX.sub(_join_vector, annotation)
+    return annotation.split(",")
+
+
+def add_annotations(node, comment):
+    """
+    Add the key=value pairs of a `[&&NHX:...]` or BEAST `[&...]` comment to a
+    node as features.  Comments in other formats are ignored.
+
+    :param node: Tree node to annotate
+    :param comment: Body of the comment, without the enclosing brackets
+    """
+    if comment.startswith("&&NHX:"):
+        fields = comment[6:].split(":")
+    elif comment.startswith("&"):
+        fields = _split_beast_annotation(comment[1:])
+    else:
+        return
+    for field in fields:
+        key, sep, value = field.partition("=")
+        if not sep:
+            # Flags such as BEAST's [&R] carry no value
+            continue
+        key = key.strip()
+        setattr(node, key, value)
+        node.features.add(key)
+
+
+def read_newick(tree_string, translate=None):
+    """
+    Parse a Newick string into an ete3 tree in a single pass.
+
+    Leaf labels become names.  Internal labels become supports if every one of
+    them is numeric and names otherwise, as ete3 would do when trying format 0
+    before format 1.  NHX and BEAST comments become node features, and
+    BEAST's composite branch lengths ("0.5@0.7") set a "rate" feature.
+
+    :param tree_string: A Newick tree, starting at "(" and ending with ";"
+    :param translate: Optional dictionary mapping labels to taxon names, e.g.
+        from a Nexus translate block
+    :return: The root node of the tree
+    :raises NewickError: if the string is not a well-formed tree
+    """
+    if not tree_string.rstrip().endswith(";"):
+        raise NewickError("Malformed newick tree structure.")
+    root = TreeNode()
+    root._dist = 0.0
+    parent = None
+    node = root
+    after_colon = False
+    internal_labels = []
+    numeric_labels = True
+    pieces = _PIECES_REGEX.split(tree_string)
+    for i in range(len(pieces)):
+        piece = pieces[i]
+        if i % 2 == 0:
+            # Text between delimiters: a label or a branch length
+            piece = piece.strip()
+            if not piece:
+                continue
+            if after_colon:
+                after_colon = False
+                if "@" in piece:
+                    piece, rate = piece.split("@", 1)
+                    node.rate = rate
+                    node.features.add("rate")
+                try:
+                    node._dist = _parse_float(piece)
+                except ValueError:
+                    raise NewickError("Invalid branch length %s" % piece)
+            elif node._children:
+                internal_labels.append((node, piece))
+                if numeric_labels:
+                    try:
+                        node._support = float(piece)
+                    except ValueError:
+                        numeric_labels = False
+            else:
+                node.name = translate.get(piece, piece) if translate else piece
+        elif piece == ",":
+            if parent is None or not (node.name or node._children):
+                raise NewickError("Empty leaf node found")
+            after_colon = False
+            node = _new_node(parent)
+        elif piece == "(":
+            if node._children or node.name:
+                raise NewickError("Unexpected '(' in tree")
+            parent = node
+            node = _new_node(parent)
+        elif piece == ")":
+            if parent is None:
+                raise NewickError("Parentheses do not match. Broken tree structure?")
+            if not (node.name or node._children):
+                raise NewickError("Empty leaf node found")
+            after_colon = False
+            node = parent
+            parent = node._up
+        elif piece == ":":
+            after_colon = True
+        elif piece == ";":
+            break
+        elif piece[0] == "[":
+            add_annotations(node, piece[1:-1])
+        else:
+            # A quoted label
+            label = piece[1:-1].replace("''", "'")
+            if node._children:
+                internal_labels.append((node, label))
+                numeric_labels = False
+            else:
+                node.name = translate.get(label, label) if translate else label
+    if node is not root or parent is not None:
+        raise NewickError("Parentheses do not match. Broken tree structure?")
+
+    if not numeric_labels:
+        for node, label in internal_labels:
+            node._support = 1.0
+            node.name = translate.get(label, label) if translate else label
+    return root
+
+
+class NewickWriter(object):
+    """
+    Formats ete3 trees as Newick strings, exactly as ete3's `write` method does
+    for format 0 (names, branch lengths and supports) and, with topology_only,
+    format 9 (leaf names only).
+
+    Leaf labels are cached across trees, as the same taxa recur in every tree
+    of a treestream.  Trees with values which cannot be formatted the fast
+    way, e.g. non-numeric branch lengths, are handed to ete3 instead.
+    """
+
+    def __init__(self, schema=None, format_root_node=False, topology_only=False, precision=6):
+        """
+        :param schema: The FeatureSchema of the features to write in NHX
+            comments, in the order of its names, or None for no comments.
+            Features of the nodes written which it does not know yet are added
+            to it.
+        :param format_root_node: Whether to write the support, branch length
+            and features of the root node
+        :param topology_only: Whether to write only the leaf names
+        :param precision: Number of significant digits of branch lengths and
+            supports
+        """
+        self.schema = schema
+        self.format_root_node = format_root_node
+        self.topology_only = topology_only
+        self.float_format = "%%0.%dg" % precision
+        self.internal_format = self.float_format + ":" + self.float_format
+        self.names = {}
+
+    def write(self, tree):
+        """
+        Return the Newick string of a tree.
+        """
+        parts = []
+        self.write_parts(tree, parts)
+        return "".join(parts)
+
+    def write_parts(self, tree, parts):
+        """
+        Append the pieces of the Newick string of a tree to a list of strings.
+        """
+        start = len(parts)
+        try:
+            self._write_parts(tree, parts)
+        except (TypeError, ValueError):
+            del parts[start:]
+            parts.append(self._ete3_write(tree))
+
+    def _ete3_write(self, tree):
+        if self.topology_only:
+            return tree.write(format=9)
+        features = None
+        if self.schema is not None:
+            self.schema.add_tree(tree)
+            features = self.schema.names or None
+        return tree.write(
+            features=features, format_root_node=self.format_root_node,
+            dist_formatter=self.float_format, support_formatter=self.float_format)
+
+    def _write_parts(self, tree, parts):
+        append = parts.append
+        topology_only = self.topology_only
+        float_format, internal_format = self.float_format, self.internal_format
+        schema = self.schema
+        known = schema.known if schema is not None and not topology_only else None
+        names = self.names
+        stack = [tree]
+        pop, push = stack.pop, stack.append
+        while stack:
+            node = pop()
+            if node.__class__ is str:
+                # A closing bracket, comma or internal node label
+                append(node)
+                continue
+            children = node._children
+            if not children:
+                name = names.get(node.name)
+                if name is None:
+                    name = self._format_name(node.name)
+                if topology_only:
+                    append(name)
+                    continue
+                append(name + ":" + float_format % float(node._dist))
+                if known is not None:
+                    if not node.features <= known:
+                        schema.update(node.features)
+                    if schema.names:
+                        append(self._features_comment(node, schema.names))
+                continue
+            append("(")
+            if topology_only or (node is tree and not self.format_root_node):
+                push(")")
+            else:
+                if known is not None:
+                    if not node.features <= known:
+                        schema.update(node.features)
+                    if schema.names:
+                        push(self._features_comment(node, schema.names))
+                push(")" + internal_format % (float(node._support), float(node._dist)))
+            push(children[-1])
+            for i in range(len(children) - 2, -1, -1):
+                push(",")
+                push(children[i])
+        append(";")
+
+    def _format_name(self, name):
+        formatted = _ILLEGAL_REGEX.sub("_", str(name))
+        if self.topology_only and not formatted:
+            formatted = "NoName"
+        self.names[name] = formatted
+        return formatted
+
+    def _features_comment(self, node, features):
+        fields = []
+        for feature in features:
+            value = getattr(node, feature, _MISSING)
+            if value is _MISSING:
+                continue
+            kind = type(value)
+            if kind is not str:
+                if kind in ITERABLE_TYPES:
+                    value = "|".join(map(str, value))
+                elif kind is dict:
+                    # Left to ete3, which does not format dicts consistently
+                    raise TypeError("Unsupported feature value")
+                else:
+                    value = str(value)
+            fields.append(feature + "=" + _ILLEGAL_REGEX.sub("_", value))
+        if fields:
+            return "[&&NHX:" + ":".join(fields) + "]"
+        return ""
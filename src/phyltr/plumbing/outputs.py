@@ -0,0 +1,130 @@
+"""
+Output files for sinks, optionally compressed, written in a background thread.
+
+Compressing the output of a long run can take as long as formatting the trees.
+`OutputWriter` collects what sinks write into large chunks and hands them to a
+thread which encodes, compresses and writes them, so that the thread which
+formats trees is not blocked by either.  zlib, bz2 and lzma release the GIL
+while they compress, so the two threads really do run at the same time.
+"""
+import bz2
+import gzip
+import lzma
+import os
+import queue
+import sys
+import threading
+
+from phyltr.plumbing.treeindex import ENCODING
+
+# How to open output files for compression, by filename extension
+COMPRESSION_EXTENSIONS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+
+# Number of characters collected before they are passed to the writer thread
+CHUNK_SIZE = 1 << 20
+# Number of chunks which may wait to be written before writes block
+QUEUE_SIZE = 8
+
+
+def get_compressor(filename):
+    """
+    Return the function which opens a file for compression according to the
+    extension of filename, or None if it should not be compressed.
+    """
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def open_output(filename):
+    """
+    Return the text file-like object sinks should write to: stdout if filename
+    is None or "-", or an OutputWriter for the file otherwise.
+    """
+    if filename is None or filename == "-":
+        return sys.stdout
+    return OutputWriter(filename)
+
+
+class OutputWriter(object):
+    """
+    A write-only text file, compressed with gzip, bzip2 or xz if its name ends
+    in .gz, .bz2 or .xz, which is written in a background thread.  Errors in
+    the writer thread are raised by the next call to write, flush or close.
+    """
+
+    def __init__(self, filename):
+        self.name = filename
+        compress = get_compressor(filename)
+        self.fp = compress(filename, "wb") if compress else open(filename, "wb")
+        self.closed = False
+        self._chunk = []
+        self._size = 0
+        self._error = None
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, s):
+        self._check()
+        self._chunk.append(s)
+        self._size += len(s)
+        if self._size >= CHUNK_SIZE:
+            self._send()
+        return len(s)
+
+    def flush(self):
+        """
+        Wait until everything written so far has been written to the file.
+        """
+        self._check()
+        self._send()
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send()
+            self._queue.put(None)
+            self._thread.join()
+        finally:
+            self.fp.close()
+        self._check()
+
+    def _send(self):
+        if self._chunk:
+            self._queue.put("".join(self._chunk))
+            self._chunk = []
+            self._size = 0
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        failed = False
+        while True:
+            chunk = self._queue.get()
+            try:
+                if chunk is None:
+                    return
+                # After an error, the remaining chunks are discarded
+                if not failed:
+                    self.fp.write(chunk.encode(ENCODING))
+            except Exception as e:
+                failed = True
+                self._error = e
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,94 @@
+import collections
+import multiprocessing
+
+from ete3 import TreeNode
+
+from phyltr.utils.featureschema import STANDARD_FEATURES
+
+# Nodes are rebuilt from their flattened data without running __init__
+_new_node = TreeNode.__new__
+
+
+def imap_ordered(func, iterable, jobs):
+    """
+    Like `multiprocessing.Pool.imap`, but with at most two tasks per worker in
+    flight, so that memory use does not grow with the length of iterable.
+
+    :param func: A picklable function of one argument
+    :param iterable: The arguments to apply func to
+    :param jobs: Number of worker processes
+    :return: Generator of the results of func, in the order of iterable
+    """
+    pool = multiprocessing.Pool(jobs)
+    pending = collections.deque()
+    try:
+        for args in iterable:
+            pending.append(pool.apply_async(func, (args,)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def flatten_tree(tree):
+    """
+    Convert a tree into flat lists of node data in preorder, with parents given
+    by their position in the lists.  Unlike the tree itself, these can be
+    pickled regardless of the depth of the tree.
+    """
+    index = {}
+    parents, names, dists, supports, features = [], [], [], [], []
+    for n, node in enumerate(tree.traverse("preorder")):
+        index[node] = n
+        parents.append(index[node._up] if n else -1)
+        names.append(node.name)
+        dists.append(node._dist)
+        supports.append(node._support)
+        if len(node.features) > 3:
+            features.append({f: getattr(node, f) for f in node.features
+                             if f not in STANDARD_FEATURES})
+        else:
+            features.append(None)
+    return parents, names, dists, supports, features
+
+
+def build_nodes(parents, names, dists, supports):
+    """
+    Build the nodes of a tree from flat lists of node data in preorder, as
+    produced by flatten_tree.
+
+    :return: The list of nodes, in the same order, with the root first
+    """
+    nodes = []
+    for parent, name, dist, support in zip(parents, names, dists, supports):
+        node = _new_node(TreeNode)
+        node._children = []
+        node._dist = dist
+        node._support = support
+        node._img_style = None
+        node.name = name
+        node.features = set(STANDARD_FEATURES)
+        if parent >= 0:
+            node._up = nodes[parent]
+            node._up._children.append(node)
+        else:
+            node._up = None
+        nodes.append(node)
+    return nodes
+
+
+def unflatten_tree(flat_tree):
+    """
+    Rebuild a tree from the output of flatten_tree.
+    """
+    parents, names, dists, supports, features = flat_tree
+    nodes = build_nodes(parents, names, dists, supports)
+    for node, extra in zip(nodes, features):
+        if extra:
+            for f, value in extra.items():
+                setattr(node, f, value)
+            node.features.update(extra)
+    return nodes[0]
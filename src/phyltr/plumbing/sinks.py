@@ -1,30 +1,53 @@
 import sys
 
+from phyltr.plumbing.binary import BinaryFormatter, use_binary
+from phyltr.plumbing.lazytree import LazyTree
+from phyltr.plumbing.newick import NewickWriter
+from phyltr.utils.featureschema import FeatureSchema
+
+# Number of pieces of Newick strings (labels, brackets, ...) collected before
+# they are joined and written out at once
+BUFFER_SIZE = 1 << 16
+
 
 class NewickFormatter:
 
-    def __init__(self, out=sys.stdout, annotations=True, topology_only=False):
+    def __init__(self, out=sys.stdout, annotations=True, topology_only=False, precision=6):
         self.out = out
         self.annotations = annotations
         self.topology_only = topology_only
+        self.precision = precision
 
     def consume(self, stream):
-        first = True
+        if self.annotations and not self.topology_only and use_binary(self.out):
+            BinaryFormatter(self.out.buffer).consume(stream)
+            return
+        if self.topology_only:
+            writer = NewickWriter(topology_only=True)
+        elif self.annotations:
+            # Features are written in the order of a schema of this stream's
+            # features, which the writer fills in as it meets them
+            writer = NewickWriter(
+                schema=FeatureSchema(), format_root_node=True, precision=self.precision)
+        else:
+            writer = NewickWriter(precision=self.precision)
+        buffer = []
         for t in stream:
-            if first:
-                first = False
-                feature_names = set()
-                for n in t.traverse():
-                    feature_names |= n.features
-                for standard_feature in ("dist", "name", "support"):
-                    feature_names.remove(standard_feature)
-            if self.topology_only:
-                self.out.write(t.write(format=9))
-            elif self.annotations:
-                self.out.write(t.write(features=feature_names, format_root_node=True))
+            newick = None
+            if isinstance(t, LazyTree) and self.annotations and not self.topology_only:
+                # Trees which were never parsed are written as they were read
+                newick = t.verbatim()
+            if newick is not None:
+                buffer.append(newick)
             else:
-                self.out.write(t.write())
-            self.out.write("\n")
+                writer.write_parts(t, buffer)
+            buffer.append("\n")
+            if len(buffer) >= BUFFER_SIZE:
+                self.out.write("".join(buffer))
+                buffer = []
+        if buffer:
+            self.out.write("".join(buffer))
+
 
 
 class NullSink:
@@ -1,39 +1,167 @@
 import fileinput
 import os
 import re
+import sys
 import tempfile
+from collections import Counter, OrderedDict
 from functools import partial
 
 import ete3
 
-_name, _annotation, _number = (
-    "(?P<name>[a-zA-Z0-9_ \-]*?)",
-    "(\[&(?P<annotation>[^\]]*)\])",
-    "(?P<dist>[0-9.]+([Ee](-?[0-9]+)?)?)"
+from phyltr.plumbing.binary import BinaryTreeReader, is_binary, read_tree
+from phyltr.plumbing.inputs import MappedFileInput
+from phyltr.plumbing.lazytree import LazyTree
+from phyltr.plumbing.newick import NewickWriter, read_newick
+from phyltr.plumbing.parallel import flatten_tree, imap_ordered, unflatten_tree
+from phyltr.plumbing.treeindex import (
+    TreeIndex, extract_tree_string, read_translation, select_trees,
 )
-BEAST_ANNOTATION_REGEX = re.compile(_name + ':' + _annotation + _number)
-BEAST_ANNOTATION_REGEX_2 = re.compile(_name + _annotation + ':' + _number)
+from phyltr.utils.featureschema import FeatureSchema
+from phyltr.utils.taxonregistry import REGISTRY
 
-_NUMBER = '[0-9]+\.[0-9]+'
-COMPOSITE_BRANCHLENGTH_REGEX = re.compile(
-    ":(?P<dist>" + _NUMBER + ")@(?P<annotation>" + _NUMBER + ")")
+NEWICK = "newick"
+NHX = "nhx"
+BEAST = "beast"
 
 
-# FIXME We should be deleting and starting a new temp file for each tree file
-# otherwise we're going to have problems if file 2 is shorter than file 1
+def annotation_dialect(tree_string):
+    """
+    Detect how the nodes of a tree string are annotated.
+
+    :return: NHX for `[&&NHX:...]` comments, which ete3 reads itself, BEAST for
+        BEAST-style `[&...]` comments or composite branch lengths
+        ("0.5@0.7"), or NEWICK for plain Newick
+    """
+    if '&&NHX' in tree_string:
+        return NHX
+    if '[&' in tree_string or '@' in tree_string:
+        return BEAST
+    return NEWICK
+
+
+_INTERNAL_LABEL_REGEX = re.compile(r"\)\s*([^\s:,;()\[]+)")
+
+
+def sniff_newick_format(tree_string):
+    """
+    Guess the ete3 format of a tree string without parsing it.
+
+    :return: 0 if all internal node labels are supports, or 1 if some are names
+    """
+    for label in _INTERNAL_LABEL_REGEX.findall(tree_string):
+        try:
+            float(label)
+        except ValueError:
+            return 1
+    return 0
+
+
+# Number of characters of tree strings sent to a worker process at a time
+BATCH_SIZE = 2 ** 20
+
+
+def _parse_batch(batch):
+    """
+    Parse a batch of tree strings in a worker process.  The trees are returned
+    flattened, as deep trees are too recursive to pickle, together with the
+    parse statistics of the batch.
+    """
+    filename, backend, translate, names, tree_strings = batch
+    parser = ComplexNewickParser(backend=backend)
+    parser.isNexus = translate is not None
+    parser.nexus_trans = translate
+    parser.binary_names = names
+    trees = [flatten_tree(t) for t in map(parser.parse_tree, tree_strings) if t]
+    return filename, trees, parser.stats
+
+
+def _parse_lazy(backend, translate, tree_string):
+    """
+    Parse the string of a LazyTree, once its structure is needed.
+    """
+    parser = ComplexNewickParser(backend=backend)
+    parser.isNexus = translate is not None
+    parser.nexus_trans = translate
+    t = parser.parse_tree(tree_string)
+    if t is None:
+        raise ete3.parser.newick.NewickError("Could not parse tree %s" % tree_string)
+    return t
+
 
 class ComplexNewickParser(object):
 
-    def __init__(self, burnin=0, subsample=1):
+    def __init__(
+            self, burnin=0, subsample=1, backend="ete3", jobs=1, lazy=False, tree_range=None):
         self.burnin = burnin
         self.subsample = subsample
+        self.tree_range = tree_range
+        self.backend = backend
+        self.jobs = jobs
+        self.lazy = lazy
         self.n = 0
-        if self.burnin:
-            self.fp = tempfile.NamedTemporaryFile(mode="w+", delete=False)
-        self.with_annotations = None
+        self.fp = None
+        self.dialect = None
         self.newick_format = None
+        self.filename = None
+        self.binary_names = None
+        self.taxa = REGISTRY
+        self.seeded = None
+        # Counts of trees which needed a second parse attempt ("retries") or
+        # could not be parsed at all ("skipped"), per input file
+        self.file_stats = OrderedDict()
+        self.stats = Counter()
 
     def consume(self, stream):
+        for t in self.parse_trees(self.tree_strings(stream)):
+            yield t
+        self.report()
+
+    @property
+    def needs_count(self):
+        """
+        Whether trees can only be selected once the number of trees in their
+        file is known.
+        """
+        return bool(self.burnin) or self.tree_range is not None
+
+    def selected(self, count):
+        """
+        Return the positions of the kept trees of a file of count trees.
+        """
+        return select_trees(count, self.burnin, self.tree_range, self.subsample)
+
+    def start_file(self, filename):
+        """
+        Forget what was learnt about the format of the previous file's trees.
+        """
+        self.dialect = None
+        self.newick_format = None
+        self.binary_names = None
+        self.filename = filename if filename != "-" else "<stdin>"
+        self.stats = self.file_stats.setdefault(self.filename, Counter())
+
+    def report(self, out=None):
+        """
+        Write the parse statistics of each file with trees which were retried
+        or skipped.
+        """
+        out = out or sys.stderr
+        for filename, stats in self.file_stats.items():
+            if stats["retries"] or stats["skipped"]:
+                out.write("%s: %d trees skipped, %d trees parsed on a second attempt\n" % (
+                    filename or "<input>", stats["skipped"], stats["retries"]))
+
+    def tree_strings(self, stream):
+        """
+        Yield the strings of the trees in stream which survive burn in and
+        subsampling.  When a string is yielded, `self.isNexus` and
+        `self.nexus_trans` describe the file it came from.
+        """
+        if isinstance(stream, MappedFileInput):
+            for tree_string in self.binary_tree_strings(stream):
+                yield tree_string
+            return
+
         _first = True
         self.isNexus = False
         # Track whether a line is the first NON-BLANK line in a file:
@@ -60,11 +188,20 @@ class ComplexNewickParser(object):
                 # then this is the second or subsequent file.  Before proceeding,
                 # we should handle the temp file full of tree strings read from
                 # the first file
-                if self.burnin and self.n > 0:
-                    for t in self.yield_from_tempfile():
-                        yield t
-                self.with_annotations = None
-                self.newick_format = None
+                if self.needs_count and self.n > 0:
+                    for tree_string in self.yield_from_tempfile():
+                        yield tree_string
+                self.start_file(self.stream_filename(stream))
+                # When burning in a regular file, locate its trees by a byte
+                # scan and seek straight to the first one we keep, rather than
+                # copying every tree into the temp file.
+                if self.needs_count:
+                    filename, skip_file = self.seekable_file(stream)
+                    if filename:
+                        for tree_string in self.indexed_tree_strings(filename):
+                            yield tree_string
+                        skip_file()
+                        continue
 
             # Skip blank lines
             if not line.strip():
@@ -81,26 +218,130 @@ class ComplexNewickParser(object):
                 start = line.index("(")
                 end = line.rindex(";") + 1
                 tree_string = line[start:end]
-                if self.burnin:
+                if self.needs_count:
                     # Save for later
+                    if self.fp is None:
+                        self.fp = tempfile.NamedTemporaryFile(mode="w+", delete=False)
                     self.fp.write(tree_string + "\n")
                 elif self.n % self.subsample == 0:
                     # Yield now
-                    t, self.with_annotations, self.newick_format = get_tree(
-                        tree_string,
-                        with_annotations=self.with_annotations,
-                        newick_format=self.newick_format)
-                    if not t:
-                        continue
-                    self.nexify_tree(t)
-                    yield t
+                    yield tree_string
                 self.n += 1
 
-        if self.burnin:
-            for t in self.yield_from_tempfile():
-                yield t
+        if self.fp is not None:
+            for tree_string in self.yield_from_tempfile():
+                yield tree_string
             self.fp.close()
             os.unlink(self.fp.name)
+            self.fp = None
+
+    def stream_filename(self, stream):
+        """
+        Return the name of the file whose lines are currently being read from
+        stream, if it has one.
+        """
+        filename = getattr(stream, "name", None)
+        if filename is None:
+            try:
+                filename = fileinput.filename()
+            except RuntimeError:
+                pass
+        return filename
+
+    def seekable_file(self, stream):
+        """
+        If the lines of stream are currently being read from a regular file,
+        return its name and a function which skips the rest of its lines.
+        Otherwise, return (None, None).
+        """
+        filename = getattr(stream, "name", None)
+        if filename is not None and hasattr(stream, "seek"):
+            def skip_file():
+                stream.seek(0, os.SEEK_END)
+        else:
+            try:
+                filename = fileinput.filename()
+            except RuntimeError:
+                return None, None
+            skip_file = fileinput.nextfile
+        if filename and os.path.isfile(filename):
+            return filename, skip_file
+        return None, None
+
+    def indexed_tree_strings(self, filename):
+        """
+        Yield the tree strings of one file which survive burn in and
+        subsampling, reading only their lines.
+        """
+        with open(filename, "rb") as fp:
+            for tree_string in self.seekable_tree_strings(fp):
+                yield tree_string
+
+    def seekable_tree_strings(self, fp):
+        index = TreeIndex.load(self.filename) if self.filename else None
+        if index is None:
+            index = TreeIndex.scan(fp)
+        self.isNexus = index.is_nexus
+        self.nexus_trans = index.translate
+        for tree_string in index.tree_strings_at(fp, self.selected(len(index))):
+            yield tree_string
+
+    def binary_tree_strings(self, stream):
+        """
+        Yield tree strings from the binary files of a MappedFileInput.  Tree
+        lines are found on the raw bytes and only those which are kept are
+        decoded.
+        """
+        for fp in stream.binary_files():
+            self.start_file(stream.filename())
+            if is_binary(fp):
+                for record in self.binary_records(fp):
+                    yield record
+                continue
+            if self.needs_count and stream.seekable():
+                for tree_string in self.seekable_tree_strings(fp):
+                    yield tree_string
+                continue
+
+            index = TreeIndex()
+            for line in index.scan_lines(fp):
+                self.isNexus = index.is_nexus
+                self.nexus_trans = index.translate
+                if self.needs_count:
+                    # Save for later
+                    if self.fp is None:
+                        self.fp = tempfile.NamedTemporaryFile(mode="w+", delete=False)
+                    self.fp.write(extract_tree_string(line) + "\n")
+                elif self.n % self.subsample == 0:
+                    yield extract_tree_string(line)
+                self.n += 1
+            if self.fp is not None:
+                for tree_string in self.yield_from_tempfile():
+                    yield tree_string
+
+        if self.fp is not None:
+            self.fp.close()
+            os.unlink(self.fp.name)
+            self.fp = None
+
+    def binary_records(self, fp):
+        """
+        Yield the tree records of a binary treestream which survive burn in and
+        subsampling.  Records are only decoded into trees by parse_tree.
+        """
+        reader = BinaryTreeReader()
+        self.isNexus = False
+        self.binary_names = reader.names
+        if not self.needs_count:
+            for record in reader.records(fp):
+                if self.n % self.subsample == 0:
+                    yield record
+                self.n += 1
+            return
+        # Records are small enough to hold a file's worth in memory
+        records = list(reader.records(fp))
+        for position in self.selected(len(records)):
+            yield records[position]
 
     def handle_nexus_stuff(self, line):
         """
@@ -129,22 +370,113 @@ class ComplexNewickParser(object):
 
         # Handle Nexus translate block
         if self.inTranslate:
-            # Detect ending of translate block...
-            if line == ";":
-                self.inTranslate = False
-            # ...or handle a line of translate block
-            else:
-                if line.endswith(";"):
-                    line = line[:-1]
-                    self.inTranslate = False
-                index, name = line.split()
-                if name.endswith(","):
-                    name = name[:-1]
+            index, name, finished = read_translation(line)
+            if index is not None:
                 self.nexus_trans[index] = name
+            self.inTranslate = not finished
             return True
 
         return False
 
+    def parse_trees(self, tree_strings):
+        """
+        Parse a stream of tree strings, skipping any which are malformed.  With
+        more than one job, batches of strings are parsed by a pool of worker
+        processes and the trees are yielded in their original order.
+
+        Lazy parsers yield LazyTrees instead, which are only parsed when they
+        are used, and raise NewickError then if they are malformed.
+        """
+        if self.lazy:
+            for tree_string in tree_strings:
+                self.seed_taxa()
+                if isinstance(tree_string, bytes):
+                    yield LazyTree(
+                        tree_string, partial(read_tree, names=self.binary_names), verbatim=False)
+                    continue
+                translate = self.nexus_trans if self.isNexus and self.nexus_trans else None
+                # Only plain Newick and NHX can be written back as they were
+                # read, BEAST annotations are converted to NHX as when eager
+                yield LazyTree(
+                    tree_string,
+                    partial(_parse_lazy, self.backend, translate),
+                    verbatim=translate is None and annotation_dialect(tree_string) != BEAST)
+            return
+        if self.jobs > 1:
+            for filename, trees, stats in imap_ordered(
+                    _parse_batch, self.batches(tree_strings), self.jobs):
+                self.file_stats.setdefault(filename, Counter()).update(stats)
+                self.seed_taxa()
+                for flat_tree in trees:
+                    yield unflatten_tree(flat_tree)
+            return
+        for tree_string in tree_strings:
+            self.seed_taxa()
+            t = self.parse_tree(tree_string)
+            if t:
+                yield t
+
+    def seed_taxa(self):
+        """
+        Give the taxa of the current file's translate table, if it has one,
+        the first free ids in the taxon registry.  Leaves themselves get their
+        ids when a command first asks for them.
+        """
+        if self.isNexus and self.nexus_trans and self.nexus_trans is not self.seeded:
+            self.taxa.seed(self.nexus_trans)
+            self.seeded = self.nexus_trans
+
+    def batches(self, tree_strings):
+        """
+        Group tree strings into batches for _parse_batch.  A batch never spans
+        two files, so that each can carry its file's name, translate table and
+        binary name table.
+        """
+        batch, size, filename, translate, names = [], 0, None, None, None
+        for tree_string in tree_strings:
+            current = self.nexus_trans if self.isNexus else None
+            if batch and (
+                    current is not translate or self.binary_names is not names
+                    or self.filename != filename or size >= BATCH_SIZE):
+                yield filename, self.backend, translate, names, batch
+                batch, size = [], 0
+            filename, translate, names = self.filename, current, self.binary_names
+            batch.append(tree_string)
+            size += len(tree_string)
+        if batch:
+            yield filename, self.backend, translate, names, batch
+
+    def parse_tree(self, tree_string):
+        """
+        Parse a tree string with the selected backend, applying any Nexus
+        translations.  Returns None if the string could not be parsed.
+        """
+        if isinstance(tree_string, bytes):
+            # A record from a binary treestream
+            return read_tree(tree_string, self.binary_names)
+        if self.backend == "native":
+            translate = self.nexus_trans if self.isNexus else None
+            try:
+                return read_newick(tree_string, translate)
+            except ete3.parser.newick.NewickError:
+                self.stats["skipped"] += 1
+                return None
+        if self.newick_format is None:
+            # Sniff the format from the first tree of each file
+            self.newick_format = sniff_newick_format(tree_string)
+        newick_format = self.newick_format
+        t, self.dialect, self.newick_format = get_tree(
+            tree_string,
+            dialect=self.dialect,
+            newick_format=self.newick_format)
+        if t:
+            if self.newick_format != newick_format:
+                self.stats["retries"] += 1
+            self.nexify_tree(t)
+        else:
+            self.stats["skipped"] += 1
+        return t
+
     def nexify_tree(self, t):
         # Apply translations from leaves up, since usually only leaves are
         # labelled so checking nodes near the root is a waste of time.
@@ -165,91 +497,44 @@ class ComplexNewickParser(object):
         return ")" in line and ";" in line and line.count("(") == line.count(")")
 
     def yield_from_tempfile(self):
-        trees_to_skip = int(round((self.burnin / 100.0) * self.n))
         self.fp.seek(0)
-        n = 0
-        for tree_string in self.fp.readlines():
-            if n < trees_to_skip:
-                n += 1
-                continue
-            if (n - trees_to_skip) % self.subsample == 0:
-                t, self.with_annotations, self.newick_format = get_tree(
-                    tree_string,
-                    with_annotations=self.with_annotations,
-                    newick_format=self.newick_format)
-                if not t:       # What situation is this guarding against?
-                    continue    # Does this muck up subsampling accuracy?
-                self.nexify_tree(t)
-                n += 1
-                yield t
-            else:
-                n += 1
+        tree_strings = self.fp.readlines()
+        for position in self.selected(len(tree_strings)):
+            yield tree_strings[position]
         self.fp.seek(0)
         self.fp.truncate()
         self.n = 0
 
 
-def repl(m, style='beast', annotation_name=None):
-    annotation_data = m.groupdict()
-    annotation = annotation_data['annotation']
-    dist = annotation_data['dist']
-    if dist.lower().endswith('e'):
-        dist = dist[:-1]
-    dist = float(dist)
-    if annotation:
-        if style == 'beast':
-            # Handle BEAST's "vector annotations"
-            # (comma-separated elements inside {}s)
-            # by replacing the commas with pipes
-            # (this approach subject to change?)
-            newbits = []
-            inside = False
-            for bit in annotation.split(","):
-                if inside:
-                    newbits[-1] += "|" + bit
-                    if "}" in bit:
-                        inside = False
-                else:
-                    newbits.append(bit)
-                    if "{" in bit:
-                        inside = True
-            annotation = ":".join(newbits)
-        else:
-            if '=' not in annotation:
-                assert annotation_name
-                annotation = "{0}={1}".format(annotation_name, annotation)
-    return "%s:%f[&&NHX:%s]" % (annotation_data.get('name', '') or '', dist, annotation)
-
-
-ANNOTATION_FORMATS = [
-    (BEAST_ANNOTATION_REGEX, repl),
-    (BEAST_ANNOTATION_REGEX_2, repl),
-    (COMPOSITE_BRANCHLENGTH_REGEX, partial(repl, style='other', annotation_name='rate')),
-]
-
-
-def get_tree(tree_string, with_annotations=None, newick_format=None):
-    # FIXME
-    # Make this much more elegant
-
-    if with_annotations is None:
-        # Do we need regex magic?
-        with_annotations = '&&NHX' in tree_string
-
-    if not with_annotations:
-        for regex, repl in ANNOTATION_FORMATS:
-            if regex.search(tree_string):
-                tree_string = regex.sub(repl, tree_string)
-
-    if newick_format is not None:  # A newick format is known from previous trees.
+def get_tree(tree_string, dialect=None, newick_format=None):
+    """
+    Parse a tree string, reading BEAST annotations with the single-pass reader
+    and everything else with ete3.
+
+    :param dialect: The annotation dialect of the tree, as returned by
+        annotation_dialect, or None to detect it from tree_string
+    :param newick_format: The ete3 format which read previous trees, if known.
+        If it fails to read this tree, the other format is tried once.
+    :return: A tuple (tree, dialect, newick_format), or (None, None, None) if
+        the string could not be parsed
+    """
+    if dialect is None:
+        dialect = annotation_dialect(tree_string)
+
+    if dialect == BEAST:
+        # Turn the comments into node features while parsing, instead of
+        # rewriting them into NHX for ete3 to parse again.
         try:
-            return ete3.Tree(tree_string, format=newick_format), with_annotations, newick_format
-        except (ValueError, ete3.parser.newick.NewickError):
-            pass
+            return read_newick(tree_string), dialect, newick_format
+        except ete3.parser.newick.NewickError:
+            return None, None, None
 
-    for newick_format in [0, 1]:
+    if newick_format is None:
+        newick_format = sniff_newick_format(tree_string)
+
+    for newick_format in [newick_format, 1 - newick_format]:
         try:
-            return ete3.Tree(tree_string, format=newick_format), with_annotations, newick_format
+            return ete3.Tree(tree_string, format=newick_format), dialect, newick_format
         except (ValueError, ete3.parser.newick.NewickError):
             pass
 
@@ -258,20 +543,127 @@ def get_tree(tree_string, with_annotations=None, newick_format=None):
 
 class NewickParser(object):
 
+    def __init__(self, backend="ete3"):
+        self.backend = backend
+        self.newick_format = None
+
     def consume(self, stream):
+        if isinstance(stream, MappedFileInput):
+            for fp in stream.binary_files():
+                if is_binary(fp):
+                    trees = BinaryTreeReader().trees(fp)
+                else:
+                    trees = self.parse_lines(stream.lines(fp))
+                for t in trees:
+                    yield t
+            return
+        for t in self.parse_lines(stream):
+            yield t
+
+    def parse_lines(self, stream):
         for tree_string in stream:
-            # Try to parse tree as is
-            try:
-                t = ete3.Tree(tree_string)
-                yield t
+            if self.backend == "native":
+                try:
+                    yield read_newick(tree_string.strip())
+                except ete3.parser.newick.NewickError:
+                    pass
                 continue
-            except (ValueError, ete3.parser.newick.NewickError):
-                pass
 
-            # Try to parse tree with internal node labels
-            try:
-                t = ete3.Tree(tree_string, format=1)
+            # Parse with the format of the previous tree, or with internal node
+            # labels if the first tree looks like it has them, and only try the
+            # other format if that fails.
+            if self.newick_format is None:
+                self.newick_format = sniff_newick_format(tree_string)
+            for newick_format in [self.newick_format, 1 - self.newick_format]:
+                try:
+                    t = ete3.Tree(tree_string, format=newick_format)
+                except (ValueError, ete3.parser.newick.NewickError):
+                    continue
+                self.newick_format = newick_format
                 yield t
-            except (ValueError, ete3.parser.newick.NewickError):
-                # That didn't fix it.  Give up
-                continue
+                break
+
+
+class NewickStrings(object):
+    """
+    A source which yields the lines of a Newick treestream unparsed, for
+    commands which parse trees elsewhere, e.g. in worker processes, with
+    `NewickStrings.trees`.  Binary treestreams are yielded as trees.
+    """
+
+    def consume(self, stream):
+        if isinstance(stream, MappedFileInput):
+            for fp in stream.binary_files():
+                if is_binary(fp):
+                    lines = BinaryTreeReader().trees(fp)
+                else:
+                    lines = stream.lines(fp)
+                for line in lines:
+                    yield line
+            return
+        for line in stream:
+            yield line
+
+    @staticmethod
+    def trees(items):
+        """
+        Parse the strings among items as NewickParser would, and pass the
+        trees among them through.
+        """
+        parser = NewickParser()
+        for item in items:
+            if isinstance(item, str):
+                for t in parser.parse_lines([item]):
+                    yield t
+            else:
+                yield item
+
+
+class RereadableNewickStrings(NewickStrings):
+    """
+    A NewickStrings source which can yield its items a second time, for
+    commands which need two passes over a treestream without keeping it in
+    memory.  Regular files are simply read again, anything else, e.g. stdin,
+    is copied to a temporary file on the first pass.
+    """
+
+    def __init__(self):
+        self.files = None
+        self.fp = None
+
+    def consume(self, stream):
+        self.close()
+        if isinstance(stream, MappedFileInput) and all(
+                filename != "-" and os.path.isfile(filename) for filename in stream.files):
+            self.files = list(stream.files)
+            for item in NewickStrings.consume(self, stream):
+                yield item
+            return
+        self.fp = tempfile.TemporaryFile(mode="w+")
+        # Trees, e.g. from binary treestreams, are spooled as Newick strings
+        # precise enough to read back the same branch lengths
+        writer = NewickWriter(schema=FeatureSchema(), format_root_node=True, precision=17)
+        for item in NewickStrings.consume(self, stream):
+            if isinstance(item, str):
+                self.fp.write(item if item.endswith("\n") else item + "\n")
+            else:
+                self.fp.write(writer.write(item) + "\n")
+            yield item
+
+    def reread(self):
+        """
+        Yield the items of the treestream consumed last again, as strings.
+        """
+        if self.files is not None:
+            return NewickStrings.consume(self, MappedFileInput(self.files))
+        self.fp.seek(0)
+        return iter(self.fp.readline, "")
+
+    def close(self):
+        """
+        Remove the temporary file of the treestream consumed last, if any.
+        """
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        self.files = None
@@ -0,0 +1,197 @@
+import json
+import os
+import re
+
+ENCODING = "utf-8"
+
+# Indices are saved next to the tree files they index, with this suffix
+INDEX_SUFFIX = ".phyltr-index"
+INDEX_VERSION = 1
+
+_TRANSLATE_REGEX = re.compile(b"translate", re.IGNORECASE)
+_TREE_REGEX = re.compile(br"\s*tree", re.IGNORECASE)
+
+
+def read_translation(line):
+    """
+    Parse one line of a Nexus translate block.
+
+    :param line: A stripped line from inside a translate block
+    :return: A tuple (index, name, finished), where index and name are None
+        for the line ";" and finished says whether the block ends here
+    """
+    if line == ";":
+        return None, None, True
+    finished = line.endswith(";")
+    if finished:
+        line = line[:-1]
+    index, name = line.split()
+    if name.endswith(","):
+        name = name[:-1]
+    return index, name, finished
+
+
+def extract_tree_string(line):
+    """
+    Decode a raw tree line and cut out the tree, from its first "(" to its
+    last ";".
+    """
+    line = line.decode(ENCODING)
+    return line[line.index("("):line.rindex(";") + 1]
+
+
+def select_trees(count, burnin=0, tree_range=None, subsample=1):
+    """
+    Return the positions of the trees of a file which are kept after burn in,
+    selecting a range and subsampling, in that order.
+
+    :param count: The number of trees in the file
+    :param burnin: Percentage of trees to discard
+    :param tree_range: A slice of the trees remaining after burn in, or None
+    :param subsample: Keep only every subsample-th tree of the range
+    :return: range
+    """
+    positions = range(count)[int(round((burnin / 100.0) * count)):]
+    if tree_range is not None:
+        positions = positions[tree_range]
+    return positions[::subsample]
+
+
+class TreeIndex(object):
+    """
+    The byte offsets of the tree lines in a tree file, together with the Nexus
+    metadata needed to read those trees back without rescanning the file.
+    """
+
+    def __init__(self, offsets=None, is_nexus=False, translate=None):
+        self.offsets = offsets if offsets is not None else []
+        self.is_nexus = is_nexus
+        self.translate = translate if translate is not None else {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def scan(cls, fp):
+        """
+        Build an index by scanning the raw bytes of a file.
+
+        :param fp: A file object or mmap opened in binary mode, positioned at
+            the start of the file
+        :return: TreeIndex
+        """
+        index = cls()
+        for _ in index.scan_lines(fp):
+            pass
+        return index
+
+    def scan_lines(self, fp):
+        """
+        Scan the raw bytes of a file, recording the offsets of its tree lines
+        and its Nexus metadata in this index as they are found.  Only the lines
+        of a Nexus translate block are decoded, tree lines are merely located.
+
+        :param fp: A file object or mmap opened in binary mode, positioned at
+            the start of the file
+        :return: Generator of the undecoded tree lines
+        """
+        try:
+            offset = fp.tell()
+        except (OSError, ValueError):
+            # Pipes have no positions, so offsets are only relative
+            offset = 0
+        first = True
+        in_translate = False
+        for line in iter(fp.readline, b""):
+            start = offset
+            offset += len(line)
+            # Avoid copying lines which may be megabytes long: test for blank
+            # lines and Nexus keywords without stripping or lowercasing
+            if line.isspace():
+                continue
+            if first:
+                first = False
+                if line.strip() == b"#NEXUS":
+                    self.is_nexus = True
+                    continue
+            if not self.is_nexus:
+                if b")" in line and b";" in line and line.count(b"(") == line.count(b")"):
+                    self.offsets.append(start)
+                    yield line
+            elif in_translate:
+                number, name, finished = read_translation(line.strip().decode(ENCODING))
+                if number is not None:
+                    self.translate[number] = name
+                in_translate = not finished
+            elif not self.offsets and _TRANSLATE_REGEX.search(line):
+                # Translate blocks always precede the trees which use them
+                in_translate = True
+            elif _TREE_REGEX.match(line):
+                self.offsets.append(start)
+                yield line
+
+    @staticmethod
+    def sidecar(filename):
+        """
+        Return the name of the file the index of a tree file is saved in.
+        """
+        return filename + INDEX_SUFFIX
+
+    def save(self, filename):
+        """
+        Save the index of a tree file to its sidecar file, together with the
+        size and modification time of the tree file.
+        """
+        stat = os.stat(filename)
+        with open(self.sidecar(filename), "w") as fp:
+            json.dump(dict(
+                version=INDEX_VERSION,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                count=len(self),
+                is_nexus=self.is_nexus,
+                translate=self.translate,
+                offsets=self.offsets), fp)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the index of a tree file from its sidecar file.
+
+        :return: TreeIndex, or None if there is no sidecar file or the size or
+            modification time of the tree file have changed since it was saved
+        """
+        try:
+            with open(cls.sidecar(filename)) as fp:
+                data = json.load(fp)
+            stat = os.stat(filename)
+        except (OSError, ValueError):
+            return None
+        if (data.get("version") != INDEX_VERSION or data["size"] != stat.st_size
+                or data["mtime_ns"] != stat.st_mtime_ns):
+            return None
+        return cls(data["offsets"], data["is_nexus"], data["translate"])
+
+    def burnin_cutoff(self, burnin):
+        """
+        Return the number of trees to discard for a burn in percentage.
+        """
+        return int(round((burnin / 100.0) * len(self)))
+
+    def tree_strings(self, fp, start=0, stop=None, step=1):
+        """
+        Seek to and decode the indexed tree lines in the given slice.
+
+        :param fp: The indexed file, opened in binary mode
+        :return: Generator of tree strings, from the first "(" to the last ";"
+            of each line
+        """
+        return self.tree_strings_at(fp, range(len(self))[start:stop:step])
+
+    def tree_strings_at(self, fp, positions):
+        """
+        Seek to and decode the indexed tree lines at the given positions.
+        """
+        for position in positions:
+            fp.seek(self.offsets[position])
+            yield extract_tree_string(fp.readline())
@@ -1,7 +1,25 @@
+import array
 import csv
 import collections
+import functools
+import itertools
+import json
 import math
 import statistics
+import weakref
+
+from phyltr.plumbing.parallel import flatten_tree, imap_ordered, unflatten_tree
+from phyltr.plumbing.sources import NewickStrings
+from phyltr.utils.phyltroptparse import VALID_LENGTHS
+from phyltr.utils.summary import Summary
+from phyltr.utils.taxonregistry import OCCURRENCE_SEPARATOR, REGISTRY
+
+# The first bytes of files written by CladeProbabilities.save_table, which
+# are followed by the table as JSON
+TABLE_MAGIC = b"\x00PHYLTR-CLADES\x02\n"
+# Approximate number of characters of Newick in each batch of trees whose
+# clades are counted by a worker process
+TABLE_BATCH_SIZE = 1 << 18
 
 
 def parse_float(value):
@@ -28,21 +46,28 @@ def add_mean_median_hpd(clade, values, prefix='', precision=4):
     Annotate a tree node with summary statistics.
 
     :param clade: Tree node to annotate
-    :param values: List of numbers to compute statistics for
+    :param values: List of numbers to compute statistics for, or a Summary of them
     :param interval: Pair of lower/upper percentiles for HPD interval
     :param prefix: Prefix to use for the feature names
     :param hpd_prefix: Prefix to use for the HPD feature
     :param precision: Precision for formatting floating point numbers
     """
-    print(values)
     precision = '' if precision is None else '.{}'.format(precision)
-    minvalue = min(values)
-    maxvalue = max(values)
-    mean = statistics.mean(values)
-    median = statistics.median(values)
-    stdev = statistics.stdev(values) if len(values) > 1 else 0
-    values.sort()
-    hpd = [values[int(x * len(values))] for x in (0.025, 0.975)]
+    if isinstance(values, Summary):
+        minvalue = values.min
+        maxvalue = values.max
+        mean = values.mean()
+        median = values.median()
+        stdev = values.stdev()
+        hpd = [values.quantile(x) for x in (0.025, 0.975)]
+    else:
+        minvalue = min(values)
+        maxvalue = max(values)
+        mean = statistics.mean(values)
+        median = statistics.median(values)
+        stdev = statistics.stdev(values) if len(values) > 1 else 0
+        values.sort()
+        hpd = [values[int(x * len(values))] for x in (0.025, 0.975)]
 
     clade.add_feature(prefix + 'min', '{:{precision}f}'.format(minvalue, precision=precision))
     clade.add_feature(prefix + 'max', '{:{precision}f}'.format(maxvalue, precision=precision))
@@ -52,34 +77,337 @@ def add_mean_median_hpd(clade, values, prefix='', precision=4):
     clade.add_feature(prefix + "HPD",
         '{:{precision}f}-{:{precision}f}'.format(*hpd, **dict(precision=precision)))
 
+def summary_statistic(values, name):
+    """
+    Return one of the VALID_LENGTHS statistics, by name, of a list of numbers
+    or a Summary of them.
+    """
+    if isinstance(values, Summary):
+        return values.statistic(name)
+    return VALID_LENGTHS[name](values)
+
+def tree_clades(tree):
+    """
+    Compute the clade, height and distance from the root of every node of a
+    tree, with one pass down the tree and one back up.
+
+    A clade is represented by a bitmask of the ids of its leaves in the taxon
+    registry, so that the clade of an internal node is the bitwise OR of those
+    of its children.  The height of a node is its distance to its farthest
+    leaf, as returned by its get_farthest_leaf method.
+
+    Clades of trees with repeated taxon names are computed by
+    _repeated_taxa_masks instead.
+
+    :return: A tuple (nodes, masks, heights, depths) of lists, with the nodes
+        in level order, as `tree.traverse()` yields them
+    """
+    nodes, parents, depths = [tree], [-1], [0.0]
+    for i, node in enumerate(nodes):
+        depth = depths[i]
+        for child in node._children:
+            nodes.append(child)
+            parents.append(i)
+            depths.append(depth + child._dist)
+
+    # Children come after their parents, so every node is complete by the
+    # time it is reached going backwards
+    count = len(nodes)
+    masks = [0] * count
+    heights = [None] * count
+    leaf_id = REGISTRY.leaf_id
+    repeated = False
+    for i in range(count - 1, -1, -1):
+        node = nodes[i]
+        if not node._children:
+            masks[i] = 1 << leaf_id(node)
+            heights[i] = 0.0
+        parent = parents[i]
+        if parent >= 0:
+            # The clades of siblings only overlap if taxon names are repeated
+            if masks[parent] & masks[i]:
+                repeated = True
+            masks[parent] |= masks[i]
+            height = heights[i] + node._dist
+            if heights[parent] is None or height > heights[parent]:
+                heights[parent] = height
+    if repeated:
+        masks = _repeated_taxa_masks(nodes, parents)
+    return nodes, masks, heights, depths
+
+
+def _repeated_taxa_masks(nodes, parents):
+    """
+    Return the clade bitmasks of the nodes of a tree with repeated taxon
+    names, given as by tree_clades.  A clade with k leaves of the same name
+    has the ids of the first k occurrences of the name, see
+    TaxonRegistry.occurrence_id, so that clades with the same names, counting
+    repeats, have the same bitmask in every tree.
+    """
+    count = len(nodes)
+    masks = [0] * count
+    names = [None] * count
+    occurrence_id = REGISTRY.occurrence_id
+    for i in range(count - 1, -1, -1):
+        node = nodes[i]
+        if not node._children:
+            names[i] = collections.Counter([node.name])
+        for name, n in names[i].items():
+            for occurrence in range(1, n + 1):
+                masks[i] |= 1 << occurrence_id(name, occurrence)
+        parent = parents[i]
+        if parent >= 0:
+            if names[parent] is None:
+                names[parent] = collections.Counter()
+            names[parent].update(names[i])
+            names[i] = None
+    return masks
+
+
+def tree_shape(nodes):
+    """
+    Return a hash of the shape and leaf names of a tree, given its nodes in
+    level order, i.e. of the number of children of each internal node and the
+    name of each leaf in that order.  Together these determine the tree, so
+    the hash changes whenever nodes are added, removed or moved or leaves are
+    renamed.
+    """
+    return hash(tuple(len(node._children) or node.name for node in nodes))
+
+
+def clade_masks(tree):
+    """
+    Return a dictionary mapping the nodes of a tree to their clade bitmasks,
+    see tree_clades.
+    """
+    nodes, masks, _, _ = tree_clades(tree)
+    return dict(zip(nodes, masks))
+
+
+def clade_mask(names):
+    """
+    Return the bitmask of the clade of the taxa with the given names.
+    """
+    mask = 0
+    for taxon_id in REGISTRY.taxon_ids(names):
+        mask |= 1 << taxon_id
+    return mask
+
+
+def clade_ids(mask):
+    """
+    Yield the taxon ids in a clade bitmask, in increasing order.
+    """
+    while mask:
+        # Pop the lowest set bit
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
+
+
+def clade_size(mask):
+    """
+    Return the number of taxa in a clade bitmask.
+    """
+    return bin(mask).count("1")
+
+
+def clade_names(mask):
+    """
+    Return the sorted names of the taxa in a clade bitmask.
+    """
+    taxon_name = REGISTRY.taxon_name
+    return sorted(taxon_name(taxon_id) for taxon_id in clade_ids(mask))
+
+
+def _remapping(names):
+    """
+    Return a function which converts clade bitmasks over the taxa with the
+    given names, in order, to bitmasks of the taxon ids of this process.
+    Ids which are already the same, usually all or most of them, are kept.
+    """
+    ids = [REGISTRY.taxon_id(name) for name in names]
+    same = 0
+    while same < len(ids) and ids[same] == same:
+        same += 1
+    if same == len(ids):
+        return lambda mask: mask
+    kept = (1 << same) - 1
+    remapped = {}
+
+    def remap(mask):
+        res = remapped.get(mask)
+        if res is None:
+            res = mask & kept
+            rest = mask ^ res
+            while rest:
+                # Pop the lowest set bit
+                bit = rest & -rest
+                res |= 1 << ids[bit.bit_length() - 1]
+                rest ^= bit
+            remapped[mask] = res
+        return res
+    return remap
+
+
+def _pack_values(values):
+    """
+    Pack a dictionary of lists of numbers into its keys, the lengths of the
+    lists and all the numbers in one array of doubles, which pickle far more
+    compactly and quickly than many short lists.  Dictionaries of Summaries
+    are returned as they are.
+    """
+    if any(isinstance(v, Summary) for v in values.values()):
+        return dict(values)
+    return (
+        list(values),
+        array.array('l', [len(v) for v in values.values()]),
+        array.array('d', itertools.chain.from_iterable(values.values())))
+
+
+def _unpack_values(packed):
+    """
+    Yield the keys and lists of numbers, or Summaries, of a dictionary
+    packed by _pack_values.
+    """
+    if isinstance(packed, dict):
+        for item in packed.items():
+            yield item
+        return
+    keys, lengths, values = packed
+    values = values.tolist()
+    start = 0
+    for key, length in zip(keys, lengths):
+        yield key, values[start:start + length]
+        start += length
+
+
+def _values_to_json(values):
+    """
+    Return a dictionary of lists of numbers or Summaries as a list of
+    [key, values] pairs which can be serialised as JSON, whose objects only
+    have string keys.
+    """
+    return [
+        [key, v.to_json() if isinstance(v, Summary) else v] for key, v in values.items()]
+
+
+def _values_from_json(pairs, summary_error, key):
+    """
+    Return the dictionary of a list returned by _values_to_json, with its keys
+    checked by the function key, and its values as lists of numbers, or as
+    Summaries if summary_error is given.
+    """
+    if summary_error is None:
+        return {key(k): [float(x) for x in v] for k, v in pairs}
+    return {key(k): Summary.from_json(v) for k, v in pairs}
+
+
+def _table_from_json(data):
+    """
+    Return the table, as returned by CladeProbabilities.to_table, of the JSON
+    data saved by CladeProbabilities.save_table, checking that it only holds
+    the numbers, names and clades of a table.
+    """
+    summary_error = data["summary_error"]
+    if summary_error is not None:
+        summary_error = float(summary_error)
+    taxa = data["taxa"]
+    if not all(isinstance(name, str) for name in taxa):
+        raise ValueError("Taxon names must be strings")
+    names = set(taxa)
+    limit = 1 << len(taxa)
+
+    def clade(mask):
+        if type(mask) is not int or not 0 < mask < limit:
+            raise ValueError("Invalid clade: %r" % (mask,))
+        return mask
+
+    def name(name):
+        if name not in names:
+            raise ValueError("Invalid taxon name: %r" % (name,))
+        return name
+
+    return {
+        "summary_error": summary_error,
+        "taxa": taxa,
+        "tree_count": int(data["tree_count"]),
+        "clade_counts": {clade(c): int(n) for c, n in data["clade_counts"]},
+        "clade_ages": _values_from_json(data["clade_ages"], summary_error, clade),
+        "clade_attributes": {
+            str(f): _values_from_json(values, summary_error, clade)
+            for f, values in data["clade_attributes"].items()},
+        "leaf_heights": _values_from_json(data["leaf_heights"], summary_error, name),
+    }
+
+
+def _count_clades(batch):
+    """
+    Count the clades of a batch of trees in a worker process, and return them
+    as a table for CladeProbabilities.merge_table.  Trees are given as Newick
+    strings or flattened trees, together with the taxon names known to the
+    parent process, so that the clade bitmasks of both processes agree.
+    """
+    summary_error, names, items = batch
+    for name in names:
+        REGISTRY.taxon_id(name)
+    cp = CladeProbabilities(summary_error=summary_error)
+    for t in NewickStrings.trees(
+            unflatten_tree(item) if isinstance(item, tuple) else item for item in items):
+        cp.add_tree(t)
+    return cp.to_table()
+
+
 class CladeProbabilities:
 
-    def __init__(self):
+    def __init__(self, summary_error=None):
+        """
+        :param summary_error: If given, the ages, attributes and leaf heights
+            of clades are kept as Summary objects with this relative error,
+            rather than as lists of all the values
+        """
 
+        if summary_error is not None and not 0 < summary_error < 1:
+            raise ValueError("The error of a summary must be between 0 and 1")
         self.tree_count = 0
+        self.summary_error = summary_error
+        new_values = list if summary_error is None else functools.partial(Summary, summary_error)
+        # Clades are keyed by their bitmasks, see clade_masks
         self.clade_counts = {}
-        self.clade_ages = collections.defaultdict(list)
-        self.clade_attributes = collections.defaultdict(lambda: collections.defaultdict(list))
-        self.leaf_heights = collections.defaultdict(list)
-        self.caches = {}
+        self.clade_ages = collections.defaultdict(new_values)
+        self.clade_attributes = collections.defaultdict(lambda: collections.defaultdict(new_values))
+        self.leaf_heights = collections.defaultdict(new_values)
+        # Clades are also numbered in the order they are first seen, so that
+        # the clades of a tree can be remembered compactly, as an array of
+        # the ids of the clades of its internal nodes in level order, with -1
+        # for nodes above a single leaf, together with the tree_shape the
+        # clades are valid for.  Trees are weakly referenced, so remembering
+        # their clades does not keep them alive.
+        self.clade_ids = {}
+        self.clades = []
+        self.caches = weakref.WeakKeyDictionary()
 
     def add_tree(self, tree):
 
         """Record clade counts for the given tree."""
 
-        cache = tree.get_cached_content()
+        nodes, masks, heights, depths = tree_clades(tree)
         self.tree_count += 1
+        ids = array.array('i')
 
-        # Find height of tree
-        irrelevant_leaf, tree_height = tree.get_farthest_leaf()
         # Record clades
-        for subtree in tree.traverse():
-            leaves = [leaf.name for leaf in cache[subtree]]
-            clade = " ".join(sorted(leaves))
+        for subtree, clade, height in zip(nodes, masks, heights):
             # Record ages of non-leaf clades
-            if len(leaves) > 1:
+            if clade & (clade - 1):
                 self.clade_counts[clade] = self.clade_counts.get(clade, 0) + 1
-                self.clade_ages[clade].append(subtree.get_farthest_leaf()[1])
+                self.clade_ages[clade].append(height)
+                clade_id = self.clade_ids.get(clade)
+                if clade_id is None:
+                    clade_id = self.clade_ids[clade] = len(self.clades)
+                    self.clades.append(clade)
+                ids.append(clade_id)
+            elif subtree._children:
+                ids.append(-1)
             extra_features = [f for f in subtree.features if f not in ("name", "dist", "support")]
             # Record annotations for all clades, even leaves
             for f in extra_features:
@@ -88,12 +416,132 @@ class CladeProbabilities:
                 except ValueError:
                     continue
         # Record leaf heights
-        leaf_heights = [(leaf.name, tree.get_distance(leaf)) for leaf in cache[tree]]
+        leaf_heights = [(node.name, depth) for node, depth in zip(nodes, depths)
+                        if not node._children]
         tree_height = max(d for (l, d) in leaf_heights)
         for leaf, leaf_height in leaf_heights:
             self.leaf_heights[leaf].append((tree_height - leaf_height))
 
-        self.caches[tree] = cache
+        self.caches[tree] = (tree_shape(nodes), ids)
+
+    def add_trees_parallel(self, trees, jobs):
+
+        """Record clade counts for a stream of trees, given as Newick strings,
+        as yielded by the NewickStrings source, or as trees, by counting
+        batches of them in jobs worker processes.  The result is the same as
+        that of add_tree for each tree in turn, except for rounding in the
+        means and variances of summaries."""
+
+        for table in imap_ordered(_count_clades, self._batches(trees), jobs):
+            self.merge_table(table)
+
+    def _batches(self, trees):
+        batch, size = [], 0
+        for i, tree in enumerate(trees):
+            if not i:
+                # Give the taxa ids here first, so that workers use the same
+                # ids, in the order add_tree would give them
+                for t in NewickStrings.trees([tree]):
+                    tree_clades(t)
+            if isinstance(tree, str):
+                size += len(tree)
+            else:
+                tree = flatten_tree(tree)
+                size += 16 * len(tree[0])
+            batch.append(tree)
+            if size >= TABLE_BATCH_SIZE:
+                yield self.summary_error, list(REGISTRY.names), batch
+                batch, size = [], 0
+        if batch:
+            yield self.summary_error, list(REGISTRY.names), batch
+
+    def merge(self, other):
+
+        """Add the clades of the trees recorded by another instance, which
+        must keep values the same way, i.e. have the same summary_error."""
+
+        self.merge_table(other.to_table())
+
+    def to_table(self):
+
+        """Return the clade counts and values as a picklable dictionary, from
+        which merge_table can add them to another instance, possibly in
+        another process.  Clades are relative to the included taxon names."""
+
+        return {
+            "summary_error": self.summary_error,
+            "taxa": REGISTRY.names,
+            "tree_count": self.tree_count,
+            "clade_counts": self.clade_counts,
+            "clade_ages": _pack_values(self.clade_ages),
+            "clade_attributes": {
+                f: _pack_values(values) for f, values in self.clade_attributes.items()},
+            "leaf_heights": _pack_values(self.leaf_heights),
+        }
+
+    def merge_table(self, table):
+
+        """Add the clades of a table returned by to_table."""
+
+        if table["summary_error"] != self.summary_error:
+            raise ValueError("Clade tables with different summary errors can't be merged")
+        if self.summary_error is None:
+            merge_values = list.extend
+        else:
+            merge_values = Summary.merge
+        remap = _remapping(table["taxa"])
+
+        self.tree_count += table["tree_count"]
+        for c, n in table["clade_counts"].items():
+            c = remap(c)
+            self.clade_counts[c] = self.clade_counts.get(c, 0) + n
+        for c, v in _unpack_values(table["clade_ages"]):
+            merge_values(self.clade_ages[remap(c)], v)
+        for f, values in table["clade_attributes"].items():
+            attribute = self.clade_attributes[f]
+            for c, v in _unpack_values(values):
+                merge_values(attribute[remap(c)], v)
+        for l, v in _unpack_values(table["leaf_heights"]):
+            merge_values(self.leaf_heights[l], v)
+
+    def save_table(self, filename):
+
+        """Save the clade counts and values to a file, from which load_table
+        can recreate them in another process, e.g. to merge the clades of
+        several runs summarised separately."""
+
+        table = {
+            "summary_error": self.summary_error,
+            "taxa": REGISTRY.names,
+            "tree_count": self.tree_count,
+            "clade_counts": list(self.clade_counts.items()),
+            "clade_ages": _values_to_json(self.clade_ages),
+            "clade_attributes": {
+                f: _values_to_json(values) for f, values in self.clade_attributes.items()},
+            "leaf_heights": _values_to_json(self.leaf_heights),
+        }
+        with open(filename, "wb") as fp:
+            fp.write(TABLE_MAGIC)
+            fp.write(json.dumps(table, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def load_table(cls, filename):
+
+        """Return a new instance with the clade counts and values saved to
+        a file by save_table.  Tables are JSON, and nothing but numbers and
+        names is read from them, so that files from any source are safe to
+        load."""
+
+        with open(filename, "rb") as fp:
+            if fp.read(len(TABLE_MAGIC)) != TABLE_MAGIC:
+                raise ValueError("%s is not a phyltr clade table" % filename)
+            try:
+                table = _table_from_json(json.loads(fp.read().decode("utf-8")))
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                raise ValueError("%s is not a valid phyltr clade table: %s" % (filename, e))
+        cp = cls(summary_error=table["summary_error"])
+        cp.merge_table(table)
+        return cp
 
     def compute_probabilities(self):
         """Populate the self.clade_probs dictionary with probability values,
@@ -106,15 +554,10 @@ class CladeProbabilities:
         probabilities of all of its constituent clades according to the
         current self.clade_probs values."""
 
-        cache = self.caches.get(t, t.get_cached_content())
         prob = 0
-        for node in t.traverse():
+        for node, clade in self.internal_clades(t):
             if node == t:
                 continue
-            leaves = [leaf.name for leaf in cache[node]]
-            if len(leaves) == 1:
-                continue
-            clade = " ".join(sorted(leaves))
             prob += math.log(self.clade_probs[clade])
         return prob
 
@@ -123,43 +566,64 @@ class CladeProbabilities:
         """Set the support attribute of the nodes in tree using the current
         self.clade_probs values."""
 
-        cache = self.caches.get(tree, tree.get_cached_content())
-        for node in tree.traverse():
-            leaves = [leaf.name for leaf in cache[node]]
-            if len(leaves) == 1:
-                continue
-            clade = " ".join(sorted(leaves))
+        for node, clade in self.internal_clades(tree):
             node.support = self.clade_probs[clade]
 
-    def save_clade_report(self, filename, threshold=0.0, age=False):
+    def internal_clades(self, tree):
+
+        """Yield the nodes of tree with more than one leaf below them, in
+        level order, together with their clade bitmasks.  The clades recorded
+        by add_tree are used unless the tree has changed shape since."""
+
+        all_nodes = list(tree.traverse())
+        nodes = [node for node in all_nodes if node._children]
+        shape, ids = self.caches.get(tree, (None, None))
+        if ids is not None and shape == tree_shape(all_nodes):
+            clades = self.clades
+            for node, clade_id in zip(nodes, ids):
+                if clade_id >= 0:
+                    yield node, clades[clade_id]
+        else:
+            masks = clade_masks(tree)
+            for node in nodes:
+                clade = masks[node]
+                if clade & (clade - 1):
+                    yield node, clade
+
+    def save_clade_report(self, fp, threshold=0.0, age=False):
         clade_probs = [(self.clade_probs[c], c) for c in self.clade_probs]
         if threshold < 1.0:
             clade_probs = [(p, c) for (p, c) in clade_probs if p >= threshold]
+        # Clades are only named for the report
+        clade_probs = [(p, " ".join(clade_names(c)), c) for (p, c) in clade_probs]
         # Sort by clade size and then case-insensitive alpha...
         clade_probs.sort(key=lambda x:(len(x[1].split()),x[1].lower()),reverse=True)
         # ...then by clade probability
         # (this results in a list sorted by probability and then name)
         clade_probs.sort(key=lambda x: x[0], reverse=True)
 
-        # Sanity check - the first clade in the sorted list *should* be the "everything" clade.
-        if clade_probs:
+        # Sanity check - the first clade in the sorted list *should* be the "everything" clade,
+        # unless taxon names are repeated, and trees may have different numbers of a taxon.
+        if clade_probs and not any(OCCURRENCE_SEPARATOR in name for name in REGISTRY.names):
             assert len(clade_probs[0][1].split()) == len(self.leaf_heights)
 
-        fp = open(filename, "w")
         writer = csv.writer(fp)
         if age:
             writer.writerow(["support","age_mean","age_95HPD_lower","age_95HPD_upper","clade taxa"])
         else:
             writer.writerow(["support","clade taxa"])
-        for p, c in clade_probs:
+        for p, name, c in clade_probs:
             if age:
                 ages = self.clade_ages[c]
-                mean = sum(ages)/len(ages)
-                ages.sort()
-                lower, median, upper = [ages[int(x*len(ages))] for x in (0.025,0.5,0.975)]
-                line = "%.4f, %.2f (%.2f-%.2f) [%s]\n" % (p, mean, lower, upper, c)
-                writer.writerow(format_floats([p, mean, lower, upper, c]))
+                if isinstance(ages, Summary):
+                    mean = ages.mean()
+                    lower, median, upper = [ages.quantile(x) for x in (0.025,0.5,0.975)]
+                else:
+                    mean = sum(ages)/len(ages)
+                    ages.sort()
+                    lower, median, upper = [ages[int(x*len(ages))] for x in (0.025,0.5,0.975)]
+                line = "%.4f, %.2f (%.2f-%.2f) [%s]\n" % (p, mean, lower, upper, name)
+                writer.writerow(format_floats([p, mean, lower, upper, name]))
             else:
-                line = "%.4f, [%s]\n" % (p, c)
-                writer.writerow(format_floats([p, c]))
-        fp.close()
+                line = "%.4f, [%s]\n" % (p, name)
+                writer.writerow(format_floats([p, name]))
@@ -0,0 +1,62 @@
+STANDARD_FEATURES = ("name", "dist", "support")
+
+
+class FeatureSchema(object):
+    """
+    The names of the node features of a treestream, other than the standard
+    name, dist and support, collected by whatever writes the features of its
+    trees, e.g. a NewickWriter, as it goes.
+
+    Each node is checked against the schema with a cheap set comparison as it
+    is written, so no separate traversal of the trees is needed to find the
+    feature names, and features which first appear in later trees are not
+    lost.  Each sink keeps its own schema, so names from one treestream never
+    end up in the output of another.
+    """
+
+    def __init__(self, names=()):
+        # All known feature names, including the standard ones
+        self.known = set(STANDARD_FEATURES)
+        # The non-standard names, sorted.  The list is replaced rather than
+        # changed when names are added, so it can safely be iterated over.
+        self.names = []
+        self.update(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.known and name not in STANDARD_FEATURES
+
+    def add(self, name):
+        """
+        Add a feature name to the schema, if it is not known yet.
+        """
+        if name not in self.known:
+            self.known.add(name)
+            self.names = sorted(self.known.difference(STANDARD_FEATURES))
+
+    def update(self, names):
+        """
+        Add several feature names to the schema.
+        """
+        for name in names:
+            self.add(name)
+
+    def add_node(self, node):
+        """
+        Add the features of a node to the schema, if they are not all known.
+        """
+        if not node.features <= self.known:
+            self.update(node.features)
+
+    def add_tree(self, tree):
+        """
+        Add the features of all the nodes of a tree to the schema.
+        """
+        for node in tree.traverse():
+            self.add_node(node)
+
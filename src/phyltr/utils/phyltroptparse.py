@@ -1,7 +1,9 @@
+import argparse
 import collections
 import statistics
 
 from phyltr.utils.misc import read_taxa, DEFAULT
+from phyltr.utils.taxonregistry import REGISTRY
 
 TAXA_FILE_OPTIONS = [
     (
@@ -53,10 +55,11 @@ def selector_from_taxa_spec(opts):
 
     inverse = getattr(opts, 'inverse', False)
     if opts.taxa:
+        taxon_ids = REGISTRY.taxon_ids(opts.taxa)
         if inverse:
-            return lambda l: l.name not in opts.taxa
+            return lambda l: REGISTRY.leaf_id(l) not in taxon_ids
         else:
-            return lambda l: l.name in opts.taxa
+            return lambda l: REGISTRY.leaf_id(l) in taxon_ids
     elif opts.attribute and opts.values:
         opts.values = opts.values.split(',')
         if inverse:
@@ -75,3 +78,34 @@ def length_option(help):
             default=list(VALID_LENGTHS.keys())[0],
             choices=list(VALID_LENGTHS.keys()),
             help=help))
+
+
+def jobs_option(help):
+    return (
+        ('-j', '--jobs'),
+        dict(action="store", dest="jobs", type=int, default=1, help=help))
+
+
+def summary_error(string):
+    """
+    Parse the relative error of summaries, which must be between 0 and 1.
+    """
+    try:
+        error = float(string)
+    except ValueError:
+        error = None
+    if error is None or not 0 < error < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid summary error '%s', expected a number between 0 and 1" % string)
+    return error
+
+
+def summary_error_option():
+    return (
+        ('--summary-error',),
+        dict(
+            type=summary_error, dest="summary_error", default=None, metavar="ERROR",
+            help="Keep a summary of bounded size of the ages and annotations of each clade "
+                 "instead of all their values, so that memory use does not grow with the number "
+                 "of trees.  Medians and HPD intervals are then estimated within this relative "
+                 "error, e.g. 0.01 (by default all values are kept and statistics are exact)"))
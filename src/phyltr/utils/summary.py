@@ -0,0 +1,187 @@
+import math
+
+# The statistics of a Summary which can be chosen by name, like VALID_LENGTHS
+STATISTICS = ("mean", "max", "min", "median")
+
+
+class Summary(object):
+    """
+    A summary of a stream of numbers whose size does not grow with the number
+    of values, for use in place of the list of all the values.
+
+    The count, mean, variance, minimum and maximum are kept exactly (the mean
+    and variance with Welford's method).  Quantiles are estimated from counts
+    of values in logarithmically sized buckets, as in the DDSketch algorithm,
+    so that every quantile is within a relative error `error` of a value at
+    the requested rank.  The number of buckets depends only on the range of
+    the values and on error, e.g. 1% error needs about 115 buckets for every
+    factor of 10 the values span.
+
+    Summaries with the same error can be merged, e.g. to combine summaries
+    computed from different parts of a treestream.
+    """
+
+    def __init__(self, error=0.01):
+        """
+        :param error: Relative error bound of quantiles, between 0 and 1
+        """
+        if not 0 < error < 1:
+            raise ValueError("The error of a summary must be between 0 and 1")
+        self.error = error
+        self.count = 0
+        self.mean_ = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        # Counts of values by bucket index, for each sign
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self._gamma = (1 + error) / (1 - error)
+        self._log_gamma = math.log(self._gamma)
+
+    def __len__(self):
+        return self.count
+
+    def _bucket(self, magnitude):
+        return int(math.ceil(math.log(magnitude) / self._log_gamma))
+
+    def _bucket_value(self, index):
+        # The value with the same relative error to both bounds of the bucket
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def append(self, value):
+        """
+        Add a value to the summary, like list.append.
+        """
+        self.count += 1
+        delta = value - self.mean_
+        self.mean_ += delta / self.count
+        self.m2 += delta * (value - self.mean_)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value > 0:
+            index = self._bucket(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < 0:
+            index = self._bucket(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zeros += 1
+
+    def merge(self, other):
+        """
+        Add the values summarised by another summary with the same error.
+        """
+        if other.error != self.error:
+            raise ValueError("Only summaries with the same error can be merged")
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean_ - self.mean_
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.mean_ += delta * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for mine, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, n in theirs.items():
+                mine[index] = mine.get(index, 0) + n
+        self.zeros += other.zeros
+
+    def to_json(self):
+        """
+        Return the state of the summary as a dictionary of numbers and lists,
+        which can be serialised as JSON and recreated with from_json.
+        """
+        return {
+            "error": self.error,
+            "count": self.count,
+            "mean": self.mean_,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+            "positive": sorted(self.positive.items()),
+            "negative": sorted(self.negative.items()),
+            "zeros": self.zeros,
+        }
+
+    @classmethod
+    def from_json(cls, state):
+        """
+        Return a summary with the state returned by to_json.
+
+        :raises ValueError: If state does not hold a summary's numbers
+        """
+        try:
+            summary = cls(float(state["error"]))
+            summary.count = int(state["count"])
+            summary.mean_ = float(state["mean"])
+            summary.m2 = float(state["m2"])
+            summary.min = float(state["min"])
+            summary.max = float(state["max"])
+            summary.positive = {int(index): int(n) for index, n in state["positive"]}
+            summary.negative = {int(index): int(n) for index, n in state["negative"]}
+            summary.zeros = int(state["zeros"])
+        except (KeyError, TypeError) as e:
+            raise ValueError("Not a summary: %s" % e)
+        return summary
+
+    def mean(self):
+        return self.mean_
+
+    def stdev(self):
+        """
+        Return the sample standard deviation, or 0 for a single value.
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def value_at(self, rank):
+        """
+        Return an estimate of the value at a 0-based rank of the sorted values.
+        """
+        if not 0 <= rank < self.count:
+            raise IndexError("rank out of range")
+        if rank == 0:
+            return self.min
+        if rank == self.count - 1:
+            return self.max
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self._bucket_value(index), self.min)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max  # pragma: no cover
+
+    def quantile(self, q):
+        """
+        Return an estimate of the value at index int(q * count) of the sorted
+        values, which is how phyltr reads quantiles off sorted lists.
+        """
+        return self.value_at(min(int(q * self.count), self.count - 1))
+
+    def median(self):
+        """
+        Return an estimate of the median, as statistics.median defines it.
+        """
+        middle = self.count // 2
+        if self.count % 2:
+            return self.value_at(middle)
+        return (self.value_at(middle - 1) + self.value_at(middle)) / 2
+
+    def statistic(self, name):
+        """
+        Return one of the STATISTICS by name.
+        """
+        if name in ("min", "max"):
+            return getattr(self, name)
+        return getattr(self, name)()
@@ -0,0 +1,97 @@
+# Separates a taxon name from the number of a repeated occurrence of it in the
+# names of the registry, see TaxonRegistry.occurrence_id
+OCCURRENCE_SEPARATOR = "\0"
+
+
+class TaxonRegistry(object):
+    """
+    Dense integer ids for the taxa of a treestream, assigned on first sight and
+    shared by its source and all the commands of a pipeline, so that taxa can
+    be compared, hashed and collected into sets or bitmasks as small ints.
+
+    Sources seed the registry from Nexus translate tables.  The id of a leaf is
+    cached on the leaf, together with its name, the first time it is asked for,
+    and the leaf's name is replaced by the registry's copy of the string, so
+    that all trees share one copy of each taxon name.  Renaming a leaf
+    invalidates the cached id.
+
+    Repeated occurrences of a taxon name in a tree can also be given ids of
+    their own, registered under the name and the number of the occurrence.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def taxon_id(self, name):
+        """
+        Return the id of a taxon name, assigning the next free id if the name
+        has not been seen before.
+        """
+        taxon_id = self.ids.get(name)
+        if taxon_id is None:
+            taxon_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return taxon_id
+
+    def taxon_ids(self, names):
+        """
+        Return the set of ids of several taxon names.
+        """
+        return frozenset(self.taxon_id(name) for name in names)
+
+    def seed(self, translate):
+        """
+        Assign ids to the taxa of a Nexus translate table, in the order they
+        are listed.
+        """
+        for name in translate.values():
+            self.taxon_id(name)
+
+    def leaf_id(self, leaf):
+        """
+        Return the id of the taxon of a leaf.
+        """
+        name = leaf.name
+        try:
+            if leaf.__dict__.get("_taxon_name") is name:
+                return leaf._taxon_id
+        except AttributeError:
+            # Leaf-like objects without attributes to cache the id in
+            return self.taxon_id(name)
+        taxon_id = self.taxon_id(name)
+        leaf.name = leaf._taxon_name = self.names[taxon_id]
+        leaf._taxon_id = taxon_id
+        return taxon_id
+
+    def occurrence_id(self, name, occurrence):
+        """
+        Return the id of the given occurrence, counting from 1, of a taxon
+        name repeated in a tree.  The first occurrence has the id of the name.
+        """
+        if occurrence > 1:
+            name = "%s%s%d" % (name, OCCURRENCE_SEPARATOR, occurrence)
+        return self.taxon_id(name)
+
+    def taxon_name(self, taxon_id):
+        """
+        Return the taxon name of an id, which is the same for all the
+        occurrences of a name.
+        """
+        return self.names[taxon_id].split(OCCURRENCE_SEPARATOR, 1)[0]
+
+    def leaf_ids(self, tree):
+        """
+        Return the list of the taxon ids of the leaves of a tree.
+        """
+        return [self.leaf_id(leaf) for leaf in tree.iter_leaves()]
+
+
+# The registry shared by everything in this process
+REGISTRY = TaxonRegistry()
@@ -1,2 +1,24 @@
+from phyltr.utils.cladeprob import tree_clades
+
+
+def topology_key(tree):
+    """
+    Return a key which is equal for two trees if and only if they have the same
+    rooted topology, as compared by `get_topology_id`, for grouping trees by
+    topology in a dictionary.
+
+    The key is the sorted tuple of the clade bitmasks of the internal nodes of
+    the tree (see `tree_clades`), which does not depend on the order of the
+    children of any node.  Trees with repeated taxon names, whose leaves do
+    not all have different bitmasks, are keyed by their `get_topology_id`
+    instead.
+    """
+    nodes, masks, _, _ = tree_clades(tree)
+    leaves = [mask for node, mask in zip(nodes, masks) if not node._children]
+    if len(set(leaves)) < len(leaves):
+        return tree.get_topology_id()
+    return tuple(sorted(mask for node, mask in zip(nodes, masks) if node._children))
+
+
 def are_same_topology(t1, t2):
-    return t1.get_topology_id() == t2.get_topology_id()
+    return topology_key(t1) == topology_key(t2)
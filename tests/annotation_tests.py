@@ -59,6 +59,18 @@ def test_extract_annotations(treefile, argfilepath):
                 assert row["f2"] == "1"
                 assert row["f3"] == "1"
 
+def test_extract_only_own_features(treefile, argfilepath):
+    # Features of the trees of earlier pipelines in the same process do not
+    # become columns
+    list(build_pipeline(
+        "annotate -f {0} -k taxon".format(argfilepath('annotation.csv')),
+        NewickParser().consume(treefile('basic.trees'))))
+    trees = list(NewickParser().consume(['(A[&&NHX:g=1],B);']))
+    with tempfile.NamedTemporaryFile(mode="r") as fp:
+        list(build_pipeline("annotate --extract -f {0}".format(fp.name), trees))
+        fp.seek(0)
+        assert csv.DictReader(fp).fieldnames == ["name", "g"]
+
 def test_extract_multiple_annotations(treefile, argfilepath):
     trees = list(NewickParser().consume(treefile('basic.trees')))
     with tempfile.NamedTemporaryFile(mode="r") as fp:
@@ -1,3 +1,5 @@
+import gzip
+
 import pytest
 
 from phyltr.commands.cat import Cat
@@ -23,6 +25,22 @@ def test_command(cmd, fname, treefilepath):
     run_command(cmd, files=[treefilepath(fname)] if fname else None)
 
 
+def test_output_file(treefilepath, tmpdir):
+    filename = str(tmpdir.join('out.trees.gz'))
+    run_command('cat --output-file ' + filename, files=[treefilepath('basic.trees')])
+    with gzip.open(filename, 'rt') as fp:
+        assert len(fp.readlines()) == 6
+
+
+def test_output_file_report(treefilepath, tmpdir):
+    filename = str(tmpdir.join('out.txt'))
+    run_command('clades --output-file ' + filename, files=[treefilepath('basic.trees')])
+    with open(filename) as fp:
+        lines = fp.read().splitlines()
+    assert lines[0] == 'support,clade taxa'
+    assert lines[1] == '1.0000,A B C D E F'
+
+
 def test_command_bad_args():
     with pytest.raises(SystemExit):
         run_command('sibling')
@@ -45,6 +63,21 @@ def test_complex_parser_on_non_newick(treefile):
 def test_complex_parser_on_non_tree(treefile):
     trees = ComplexNewickParser().consume(treefile('not_trees.trees'))
     assert sum((1 for t in trees)) == 0
+    trees = ComplexNewickParser(backend="native").consume(treefile('not_trees.trees'))
+    assert sum((1 for t in trees)) == 0
+
+@pytest.mark.parametrize(
+    'fname',
+    ['basic.trees', 'internal_names.trees', 'beast_output.nex', 'mr_bayes_output.nex'])
+def test_native_backend(treefile, fname):
+    ete3_trees = list(ComplexNewickParser().consume(treefile(fname)))
+    native_trees = list(ComplexNewickParser(backend="native").consume(treefile(fname)))
+    assert len(ete3_trees) == len(native_trees)
+    for t1, t2 in zip(ete3_trees, native_trees):
+        assert t1.write(format=1) == t2.write(format=1)
+    ete3_count = sum((1 for t in NewickParser().consume(treefile(fname))))
+    native_count = sum((1 for t in NewickParser(backend="native").consume(treefile(fname))))
+    assert ete3_count == native_count
 
 def test_beast_nexus_output(treefile):
     trees = ComplexNewickParser().consume(treefile('beast_output.nex'))
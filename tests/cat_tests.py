@@ -1,4 +1,12 @@
+from io import StringIO
+
+import pytest
+
+from phyltr import build_pipeline
 from phyltr.commands.cat import Cat
+from phyltr.plumbing.inputs import MappedFileInput
+from phyltr.plumbing.sinks import NewickFormatter
+from phyltr.plumbing.sources import NewickParser
 
 
 def test_basic_cat(basictrees):
@@ -27,3 +35,65 @@ def test_mr_bayes_nexus_output_cat(treefilenewick):
     trees = Cat().consume(treefilenewick('mr_bayes_output.nex'))
     for t in trees:
         assert len(t.get_leaves()) == 12
+
+def test_native_parser_annotations(treefile):
+    cat = Cat.init_from_args("--parser native")
+    trees = cat.consume(cat.init_source().consume(treefile('beast_output_geo_annotations.nex')))
+    for t in trees:
+        for n in t.traverse():
+            assert n.location.startswith("{") and "|" in n.location
+
+def test_jobs(treefilepath):
+    assert Cat.init_from_args("--jobs 4").opts.jobs == 4
+    trees = list(build_pipeline("cat --jobs 2 --subsample 2", treefilepath('mr_bayes_output.nex')))
+    assert len(trees) == 5
+    assert all(len(t.get_leaves()) == 12 for t in trees)
+
+def test_lazy(treefile):
+    cat = Cat.init_from_args("--lazy -s 2")
+    trees = list(cat.consume(cat.init_source().consume(treefile('basic.trees'))))
+    assert len(trees) == 3
+    assert trees[0].verbatim() == '(((A,B),C),(D,(E,F)));'
+
+def test_lazy_beast_annotations(treefile, tmpdir):
+    # BEAST-annotated Newick, which only phyltr cat can read
+    beast = tmpdir.join('beast.trees')
+    beast.write(''.join(
+        line.split('=', 1)[1].replace('[&R]', '').strip() + '\n'
+        for line in treefile('beast_output_rate_annotations.nex')
+        if line.startswith('tree ')))
+    cat = Cat.init_from_args("--lazy")
+    trees = list(cat.consume(cat.init_source().consume(MappedFileInput([str(beast)]))))
+    assert not any(t.verbatim() for t in trees)
+    out = StringIO()
+    NewickFormatter(out).consume(trees)
+    # The output can be read by the next command of a pipeline
+    piped = list(build_pipeline(
+        "support", NewickParser().consume(out.getvalue().splitlines(True))))
+    assert len(piped) == 10
+    for t in piped:
+        assert sorted(int(l.name) for l in t.iter_leaves()) == list(range(1, 27))
+        assert all(hasattr(l, 'rate') for l in t.iter_leaves())
+
+@pytest.mark.parametrize(
+    'args,expected',
+    [
+        ('--range 2:5', [2, 3, 4]),
+        ('--range=-2:', [4, 5]),
+        ('--range ::2 -s 2', [0, 4]),
+        ('--range 0:2 -b 50', [3, 4]),
+    ]
+)
+def test_range(treefilepath, basictrees, args, expected):
+    trees = [t.write() for t in basictrees]
+    cat = Cat.init_from_args(args)
+    # Regular files are read through an index, stdin is not
+    for source in (MappedFileInput([treefilepath('basic.trees')]), iter(trees)):
+        out = cat.consume(cat.init_source().consume(source))
+        assert [t.write() for t in out] == [trees[i] for i in expected]
+
+
+@pytest.mark.parametrize('range_', ['1', '1:2:0', 'a:b'])
+def test_invalid_range(range_):
+    with pytest.raises(SystemExit):
+        Cat.init_from_args("--range=%s" % range_)
@@ -1,5 +1,8 @@
-from phyltr import build_pipeline
+import pytest
+
+from phyltr import build_pipeline, run_command
 from phyltr.commands.clades import Clades
+from phyltr.utils.cladeprob import clade_mask
 
 def test_init_from_args():
     clades = Clades.init_from_args("")
@@ -12,30 +15,108 @@ def test_init_from_args():
     clades = Clades.init_from_args("-f 0.42")
     assert clades.opts.frequency == 0.42
 
+    clades = Clades.init_from_args("--summary-error 0.01")
+    assert clades.opts.summary_error == 0.01
+    for error in ("0", "2", "x"):
+        with pytest.raises(SystemExit):
+            Clades.init_from_args("--summary-error " + error)
+    with pytest.raises(ValueError):
+        Clades(summary_error=2)
+
 def test_clades(basictrees):
     clades = Clades(ages=True)
     # Spin through all trees
     list(clades.consume(basictrees))
     # Check that the computed probabilities agree
     # with hand calculated equivalents
-    assert clades.cp.clade_probs["A B"] == 4.0 / 6.0
-    assert clades.cp.clade_probs["A C"] == 2.0 / 6.0
-    assert clades.cp.clade_probs["A B C"] == 5.0 / 6.0
-    assert clades.cp.clade_probs["E F"] == 3.0 / 6.0
-    assert clades.cp.clade_probs["A C"] == 2.0 / 6.0
-    assert clades.cp.clade_probs["D F"] == 1.0 / 6.0
-    assert clades.cp.clade_probs["D E"] == 1.0 / 6.0
-    assert clades.cp.clade_probs["C E"] == 1.0 / 6.0
-    assert clades.cp.clade_probs["D E F"] == 5.0 / 6.0
-    assert clades.cp.clade_probs["A B C D E F"] == 6.0 / 6.0
+    probs = {c: clades.cp.clade_probs[clade_mask(c.split())] for c in [
+        "A B", "A C", "A B C", "E F", "D F", "D E", "C E", "D E F", "A B C D E F"]}
+    assert probs["A B"] == 4.0 / 6.0
+    assert probs["A C"] == 2.0 / 6.0
+    assert probs["A B C"] == 5.0 / 6.0
+    assert probs["E F"] == 3.0 / 6.0
+    assert probs["A C"] == 2.0 / 6.0
+    assert probs["D F"] == 1.0 / 6.0
+    assert probs["D E"] == 1.0 / 6.0
+    assert probs["C E"] == 1.0 / 6.0
+    assert probs["D E F"] == 5.0 / 6.0
+    assert probs["A B C D E F"] == 6.0 / 6.0
 
 def test_degenerate_clades(treefilenewick):
     clades = Clades(ages=True)
     list(clades.consume(treefilenewick('single_taxon.trees')))
 
+def test_duplicate_taxa_clades(treefilepath, tmpdir):
+    out = str(tmpdir.join('out'))
+    run_command('clades --output-file ' + out, files=[treefilepath('duplicate_taxa.trees')])
+    with open(out) as fp:
+        lines = fp.read().splitlines()
+    assert lines[1:4] == ['1.0000,A A B C E F', '0.8333,A E F', '0.8333,A B C']
+
 def test_categorical_annotation(treefilenewick):
     # This is just to make sure the clade probability calculator doesnt't
     # erroneously try to calculate means etc. of categorical annotations
     list(build_pipeline(
         "annotate -f tests/argfiles/categorical_annotation.csv -k taxon | clades",
         treefilenewick('basic.trees')))
+
+def test_merge_tables(treefilenewick, tmpdir):
+    trees = treefilenewick('beast_output_rate_annotations.nex')
+    everything = Clades()
+    list(everything.consume(trees))
+
+    tables = []
+    for i, half in enumerate((trees[:len(trees) // 2], trees[len(trees) // 2:])):
+        tables.append(str(tmpdir.join('run%d.table' % i)))
+        list(Clades(save_table=tables[-1]).consume(half))
+    merged = Clades(merge_tables=tables)
+    list(merged.consume([]))
+
+    for attr in ('tree_count', 'clade_counts', 'clade_probs', 'clade_ages', 'leaf_heights'):
+        assert getattr(merged.cp, attr) == getattr(everything.cp, attr)
+    assert merged.cp.clade_attributes['rate'] == everything.cp.clade_attributes['rate']
+
+def test_merge_tables_only(treefilepath, tmpdir, monkeypatch):
+    import io
+    import sys
+
+    table, exact_table, out = [str(tmpdir.join(f)) for f in ('t', 'exact_t', 'out')]
+    run_command('clades --summary-error 0.01 --save-table ' + table + ' --output-file ' + out,
+                files=[treefilepath('basic.trees')])
+    run_command('clades --save-table ' + exact_table + ' --output-file ' + out,
+                files=[treefilepath('basic.trees')])
+
+    # Only the tables are read, not stdin, unless it is given as a file
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('(((A,B),C),(D,(E,F)));\n' * 6))
+    run_command('clades --merge-tables ' + table + ' ' + table + ' --output-file ' + out)
+    with open(out) as fp:
+        assert '0.5000,E F' in fp.read().splitlines()
+    run_command(
+        'clades - --summary-error 0.01 --merge-tables ' + table + ' --output-file ' + out)
+    with open(out) as fp:
+        assert '0.7500,E F' in fp.read().splitlines()
+
+    # Tables which can't be merged are usage errors
+    for tables in (table + ' ' + exact_table, str(tmpdir.join('missing'))):
+        with pytest.raises(SystemExit):
+            run_command('clades --merge-tables ' + tables + ' --output-file ' + out)
+
+def test_parallel_clades(treefilenewick, monkeypatch):
+    import io
+    from phyltr.plumbing.sinks import NewickFormatter
+    from phyltr.plumbing.sources import NewickParser
+    from phyltr.utils import cladeprob
+
+    out = io.StringIO()
+    NewickFormatter(out).consume(treefilenewick('beast_output_rate_annotations.nex'))
+    lines = out.getvalue().splitlines(True)
+    serial = Clades()
+    list(serial.consume(NewickParser().consume(lines)))
+
+    # Several batches of a few trees each
+    monkeypatch.setattr(cladeprob, 'TABLE_BATCH_SIZE', 3 * len(lines[0]))
+    parallel = Clades(jobs=2)
+    list(parallel.consume(lines))
+    for attr in ('tree_count', 'clade_counts', 'clade_ages', 'leaf_heights', 'clade_attributes'):
+        assert getattr(parallel.cp, attr) == getattr(serial.cp, attr)
+    assert list(parallel.cp.clade_counts) == list(serial.cp.clade_counts)
@@ -1,12 +1,17 @@
+import subprocess
+import sys
+
+import pytest
+
 from phyltr.commands.consensus import Consensus
 from phyltr.commands.length import Length
 
 def test_init_from_args():
     consensus = Consensus.init_from_args("")
-    assert consensus.opts.frequency == 0.5
+    assert consensus.opts.frequency == [0.5]
 
     consensus = Consensus.init_from_args("-f 0.42")
-    assert consensus.opts.frequency == 0.42
+    assert consensus.opts.frequency == [0.42]
 
 def test_consensus(basictrees):
     consensus = list(Consensus().consume(basictrees))
@@ -16,6 +21,17 @@ def test_low_freq_consensus(treefilenewick):
     consensus = list(Consensus(frequency=0.25).consume(treefilenewick('beast_output.nex')))
     assert len(consensus) == 1
 
+def test_multiple_frequency_consensus(treefilenewick):
+    trees = treefilenewick('beast_output.nex')
+    frequencies = [0.5, 0.75, 0.95, 0.0]
+    consensus = list(Consensus(frequency=frequencies).consume(trees))
+    assert len(consensus) == len(frequencies)
+    for frequency, t in zip(frequencies, consensus):
+        single = list(Consensus(frequency=frequency).consume(trees))[0]
+        assert t.write(features=[]) == single.write(features=[])
+    assert len(consensus[0]) == len(consensus[3])
+    assert len(consensus[3].get_descendants()) >= len(consensus[0].get_descendants())
+
 def test_annotation_consensus(treefilenewick):
     consensus = list(Consensus().consume(treefilenewick('beast_output_rate_annotations.nex')))[0]
     for n in consensus.traverse():
@@ -39,3 +55,76 @@ def test_min_med_max_consensus(basictrees):
 
     for l, m, L in res:
         assert l <= m <= L
+
+def test_summary_consensus(treefilenewick):
+    trees = treefilenewick('beast_output_rate_annotations.nex')
+    exact = list(Consensus().consume(trees))[0]
+    summarised = list(Consensus(summary_error=0.001).consume(trees))[0]
+    assert exact.write(format=9) == summarised.write(format=9)
+    for n, m in zip(exact.traverse(), summarised.traverse()):
+        assert m.dist == pytest.approx(n.dist, rel=0.01, abs=1e-6)
+        if not n.is_leaf():
+            assert float(m.age_median) == pytest.approx(float(n.age_median), rel=0.01)
+
+
+MEMORY_SCRIPT = """
+import random, resource
+from phyltr.commands.consensus import Consensus
+from phyltr.plumbing.sources import NewickParser
+
+def subtree(taxa):
+    if len(taxa) == 1:
+        return "%s:%f" % (taxa[0], random.random())
+    half = len(taxa) // 2
+    return "(%s,%s):%f" % (subtree(taxa[:half]), subtree(taxa[half:]), random.random())
+
+taxa = ["T%d" % i for i in range(64)]
+lines = (subtree(taxa) + ";" for _ in range({0}))
+list(Consensus(summary_error=0.01).consume(NewickParser().consume(lines)))
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="ru_maxrss is in KiB on Linux")
+def test_consensus_memory():
+    def peak_rss(trees):
+        return int(subprocess.check_output([sys.executable, '-c', MEMORY_SCRIPT.format(trees)]))
+    # Each of these trees takes about 100 KiB as ete3 objects, so peak memory
+    # would grow by about 90 MiB if they were kept alive
+    growth = peak_rss(1000) - peak_rss(100)
+    assert growth < 10 * 1024
+
+
+@pytest.mark.parametrize('fname', ['basic.trees', 'mid_signal.trees', 'low_signal.trees'])
+def test_parallel_consensus(treefilepath, fname):
+    # In fresh processes, so that taxa get their ids from this treestream alone
+    def consensus(args):
+        with open(treefilepath(fname)) as fp:
+            return subprocess.check_output(
+                [sys.executable, '-m', 'phyltr', 'consensus'] + args, stdin=fp)
+    assert consensus(['--jobs', '2']) == consensus([])
+
+
+def test_identical_trees_consensus():
+    from ete3 import Tree
+
+    newick = '((A:1,(B:1,C:1):2):1,((D:1,E:1):1,(F:2,(G:1,H:1):1):1):1);'
+    consensus = list(Consensus().consume([Tree(newick) for _ in range(3)]))[0]
+    assert consensus.robinson_foulds(Tree(newick))[0] == 0
+    assert all(n.support == 1.0 for n in consensus.traverse())
+
+def test_conflicting_half_support_consensus():
+    from ete3 import Tree
+
+    trees = [Tree('((A,B),(C,D));'), Tree('((A,C),(B,D));')]
+    consensus = list(Consensus().consume(trees))[0]
+    assert sorted(consensus.get_leaf_names()) == ['A', 'B', 'C', 'D']
+    assert len(consensus.get_children()) == 2
+
+def test_enforce_consistency():
+    from phyltr.utils.cladeprob import clade_mask
+
+    clades = [(p, clade_mask(names)) for p, names in [
+        (0.6, 'ABC'), (0.4, 'CD'), (0.4, 'AB'), (0.3, 'BC'), (0.2, 'DE'), (0.1, 'ABCDE')]]
+    accepted = Consensus(frequency=0.1).enforce_consistency(clades)
+    assert accepted == [clades[i] for i in (0, 2, 4, 5)]
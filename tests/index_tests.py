@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import pytest
+
+from phyltr.commands.cat import Cat
+from phyltr.commands.index import Index
+from phyltr.plumbing.inputs import MappedFileInput
+from phyltr.plumbing.treeindex import TreeIndex
+
+
+@pytest.fixture
+def nexusfile(treefilepath, tmpdir):
+    path = str(tmpdir.join('beast_output.nex'))
+    shutil.copy(treefilepath('beast_output.nex'), path)
+    return path
+
+
+def test_init_from_args():
+    Index.init_from_args("file.trees")
+
+
+def test_index(nexusfile):
+    assert list(Index(files=[nexusfile]).consume([])) == ["%s: 10 trees" % nexusfile]
+    index = TreeIndex.load(nexusfile)
+    assert index.is_nexus
+    assert len(index) == 10
+    assert len(index.translate) == 26
+
+    # Changing the file invalidates the index
+    stat = os.stat(nexusfile)
+    os.utime(nexusfile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert TreeIndex.load(nexusfile) is None
+
+
+def test_cat_uses_index(nexusfile, mocker):
+    expected = [t.write() for t in Cat.init_from_args("-b 20").init_source().consume(
+        MappedFileInput([nexusfile]))]
+    list(Index(files=[nexusfile]).consume([]))
+    scan = mocker.spy(TreeIndex, 'scan')
+    cat = Cat.init_from_args("-b 20")
+    trees = cat.consume(cat.init_source().consume(MappedFileInput([nexusfile])))
+    assert [t.write() for t in trees] == expected
+    assert scan.call_count == 0
@@ -0,0 +1,51 @@
+from phyltr import run_command
+from phyltr.commands.mcc import Mcc
+from phyltr.commands.support import Support
+from phyltr.plumbing.sources import NewickParser
+
+
+def test_init_from_args():
+    mcc = Mcc.init_from_args("")
+    assert mcc.opts.files == []
+    assert mcc.opts.jobs == 1
+
+    mcc = Mcc.init_from_args("-j 2 --summary-error 0.01 a.trees b.trees")
+    assert mcc.opts.files == ["a.trees", "b.trees"]
+    assert mcc.opts.jobs == 2
+    assert mcc.opts.summary_error == 0.01
+
+
+def test_mcc(treefilenewick):
+    trees = treefilenewick('basic.trees')
+    mcc = list(Mcc().consume(trees))
+    assert len(mcc) == 1
+    best = list(Support(sort=True).consume(trees))[0]
+    assert mcc[0].robinson_foulds(best)[0] == 0
+    assert [n.support for n in mcc[0].traverse()] == [n.support for n in best.traverse()]
+    for n in mcc[0].traverse():
+        if not n.is_leaf():
+            for attr in ("age_mean", "age_median", "age_HPD"):
+                assert hasattr(n, attr)
+
+
+def test_mcc_annotations(treefilenewick):
+    trees = treefilenewick('beast_output_rate_annotations.nex')
+    mcc = list(Mcc(summary_error=0.01).consume(trees))[0]
+    for n in mcc.traverse():
+        for attr in ("rate_mean", "rate_median", "rate_HPD"):
+            assert hasattr(n, attr)
+
+
+def test_mcc_file(treefilepath, treefile, tmpdir):
+    # Regular files are read twice rather than spooled
+    filename = str(tmpdir.join('mcc.trees'))
+    run_command('mcc --output-file ' + filename, files=[treefilepath('basic.trees')])
+    with open(filename) as fp:
+        from_file = list(NewickParser().consume(fp))
+    from_stream = list(Mcc().consume(treefile('basic.trees')))
+    assert len(from_file) == 1
+    assert from_file[0].write() == from_stream[0].write()
+
+
+def test_mcc_empty():
+    assert list(Mcc().consume([])) == []
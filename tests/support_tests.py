@@ -1,4 +1,8 @@
+import pytest
+
+from phyltr.commands.mcc import Mcc
 from phyltr.commands.support import Support
+from phyltr.plumbing.sources import NewickParser
 
 def test_init_from_args():
 
@@ -24,3 +28,29 @@ def test_clades(basictrees):
             assert hasattr(n, "support")
             assert type(n.support) == float
             assert 0 <= n.support <= 1
+
+def test_parallel_support(treefile, monkeypatch):
+    from phyltr.utils import cladeprob
+
+    monkeypatch.setattr(cladeprob, 'TABLE_BATCH_SIZE', 50)
+    lines = list(treefile('basic.trees'))
+    serial = list(Support(sort=True).consume(NewickParser().consume(lines)))
+    parallel = list(Support(sort=True, jobs=2).consume(lines))
+    assert [t.write(features=['support']) for t in parallel] == \
+        [t.write(features=['support']) for t in serial]
+
+@pytest.mark.parametrize('fname,first', [
+    (
+        'duplicate_taxa.trees',
+        '(((A:1,B:1)0.666667:1,C:1)0.833333:1,(A:1,(E:1,F:1)0.5:1)0.833333:1)1:0;'),
+    (
+        'monophyletic_dupe_taxa.trees',
+        '((((A:1,A:1)0.4:1,B:1)0.4:1,C:1)0.4:1,(D:1,(E:1,F:1)0.6:1)0.6:1)0.4:0;'),
+])
+def test_duplicate_taxa(treefilenewick, fname, first):
+    # Clades are compared by their taxon names, counting repeats, so that e.g.
+    # (A,A) is a clade of two taxa
+    trees = list(Support().consume(treefilenewick(fname)))
+    assert trees[0].write(format_root_node=True) == first
+    mcc = list(Mcc().consume(treefilenewick(fname)))[0]
+    assert mcc.write(format=9) == trees[0].write(format=9)
@@ -1,11 +1,30 @@
+import bz2
+import copy
 import fileinput
+import gzip
+import io
+import lzma
+import os
+import sys
+import tempfile
+from contextlib import closing
 from io import StringIO
 
 import pytest
 from ete3 import Tree
+from phyltr import run_command
 
-from phyltr.plumbing.sources import ComplexNewickParser, get_tree
-from phyltr.plumbing.sinks import NewickFormatter
+from phyltr.plumbing.sources import ComplexNewickParser, NewickParser, get_tree, sniff_newick_format
+from phyltr.plumbing.sinks import NewickFormatter, StringFormatter
+from phyltr.plumbing.newick import read_newick, NewickError, NewickWriter
+from phyltr.plumbing.treeindex import TreeIndex
+from phyltr.plumbing.inputs import MappedFileInput
+from phyltr.plumbing.outputs import OutputWriter
+from phyltr.plumbing.parallel import flatten_tree, unflatten_tree
+from phyltr.plumbing.lazytree import LazyTree
+from phyltr.plumbing.binary import BinaryFormatter, BinaryTreeReader, use_binary
+from phyltr.utils.featureschema import FeatureSchema
+from phyltr.utils.taxonregistry import TaxonRegistry
 
 
 @pytest.mark.parametrize(
@@ -23,6 +42,54 @@ def test_NewickFormatter(kw, in_, out):
     assert buf.read().strip() == out
 
 
+def test_NewickFormatter_precision():
+    buf = StringIO()
+    NewickFormatter(out=buf, annotations=False, precision=2).consume([Tree('(A:0.123,B:2);')])
+    assert buf.getvalue() == '(A:0.12,B:2);\n'
+
+
+def test_NewickFormatter_late_features():
+    # Features which first appear in a later tree are not dropped
+    buf = StringIO()
+    NewickFormatter(out=buf).consume([Tree('(A,B);'), Tree('(A[&&NHX:late=1],B);')])
+    assert 'late=1' in buf.getvalue().splitlines()[1]
+
+
+def test_NewickFormatter_own_features():
+    # Each stream is written with the features of its own trees only
+    for newick in ['(A[&&NHX:first=1],B);', '(A[&&NHX:second=1],B);']:
+        buf = StringIO()
+        NewickFormatter(out=buf).consume(NewickParser().consume([newick]))
+        assert buf.getvalue() == newick.replace('A', 'A:1').replace('B', 'B:1')[:-1] + '1:0;\n'
+
+
+@pytest.mark.parametrize(
+    'newick',
+    [
+        'A:1;',
+        '(A:1,(B:1,(E:1,D:1)0.9:0.5):0.123456789);',
+        '(A[&&NHX:x=1],(B[&&NHX:y=a_b],(E,D)[&&NHX:x=2:z=3])[&&NHX:x=0.5]);',
+        '((Z,A),(B,C));',
+    ]
+)
+def test_NewickWriter(newick):
+    t = Tree(newick)
+    t.get_leaves()[0].name = ''
+    t.get_leaves()[-1].add_feature('x', ['a:b', 1])
+    t.get_leaves()[-1].name = 'D (x)'
+    features = set()
+    for n in t.traverse():
+        features |= n.features
+    features = sorted(features - {'dist', 'name', 'support'})
+    for kw, expected in [
+        (dict(schema=FeatureSchema(), format_root_node=True),
+         t.write(features=features or None, format_root_node=True)),
+        (dict(), t.write()),
+        (dict(topology_only=True), t.write(format=9)),
+    ]:
+        assert NewickWriter(**kw).write(t) == expected
+
+
 def test_ComplexNewickParser():
     p = ComplexNewickParser()
     fileinput._state = None
@@ -66,8 +133,323 @@ def test_get_tree(newick, attrs):
             assert getattr(root, attr) == value
 
 
+@pytest.mark.parametrize(
+    'newick,attrs',
+    [
+        (
+            '(A,B)C;',
+            dict(name='C', dist=0.0)),
+        (
+            '(A:0.5,B:0.5)0.9:0.5;',
+            dict(name='', support=0.9, dist=0.5)),
+        (
+            '(A:0.5,B:0.5)[&rate=0.123E-4,location={12.3,4.56}]:0.5e1;',
+            dict(name='', dist=0.5e1, rate='0.123E-4', location='{12.3|4.56}')),
+        (
+            '(A:0.5,B:0.5):[&rate=0.123E-4,location={12.3,4.56}]0.5E;',
+            dict(name='', dist=0.5, rate='0.123E-4', location='{12.3|4.56}')),
+        (
+            '(A:0.5,B:0.5)C:0.5@0.7;',
+            dict(name='C', rate='0.7', dist=0.5)),
+        (
+            "(A:0.5,B:0.5)'C D':0.5[&&NHX:x=1:y=2];",
+            dict(name='C D', x='1', y='2')),
+    ]
+)
+def test_read_newick(newick, attrs):
+    root = read_newick(newick)
+    for attr, value in attrs.items():
+        if isinstance(value, float):
+            assert getattr(root, attr) == pytest.approx(value)
+        else:
+            assert getattr(root, attr) == value
+
+
+def test_read_newick_internal_names():
+    # A single non-numeric internal label turns all internal labels into names
+    t = read_newick("((A,B)1,(C,D)x)0.5;")
+    assert [n.name for n in t.traverse() if not n.is_leaf()] == ['0.5', '1', 'x']
+    assert all(n.support == 1.0 for n in t.traverse())
+    t = read_newick("((A,B)1,(C,D)2);", translate={'A': 'Alpha'})
+    assert t.children[0].support == 1.0
+    assert t.get_leaf_names() == ['Alpha', 'B', 'C', 'D']
+
+
+@pytest.mark.parametrize('newick', ['(A,(,B,));', '(((,,,)));', '((A,B);', '(A,B));', ''])
+def test_read_newick_malformed(newick):
+    with pytest.raises(NewickError):
+        read_newick(newick)
+
+
 def test_get_tree_wrong_format():
     # Try to read  a tree with format 0 ...
     res = get_tree("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", newick_format=0)
     # ... but get told it can only be read with format 1:
     assert res[2] == 1
+
+
+@pytest.mark.parametrize(
+    'newick,format_',
+    [
+        ('(A,B);', 0),
+        ('(A:1,(B:1,C:1)0.9:0.5)1.0;', 0),
+        ('(A:1,(B:1,C:1)Internal_1:0.5)Root;', 1),
+        ("(A,(B,C)'Internal 1');", 1),
+        ('(A,(B,C)[&rate=0.5]:0.5);', 0),
+    ]
+)
+def test_sniff_newick_format(newick, format_):
+    assert sniff_newick_format(newick) == format_
+
+
+def test_ComplexNewickParser_stats():
+    p = ComplexNewickParser()
+    lines = ['(A,(B,C)0.5);\n', '(A,(B,C)x);\n', '(A,(B,C)y);\n', '(A,(B,C)(D));\n']
+    assert len(list(p.consume(lines))) == 3
+    stats = list(p.file_stats.values())[0]
+    assert stats['retries'] == 1
+    assert stats['skipped'] == 1
+    out = StringIO()
+    p.report(out)
+    assert '1 trees skipped, 1 trees parsed on a second attempt' in out.getvalue()
+
+
+def test_TreeIndex(treefilepath):
+    with open(treefilepath('beast_output.nex'), 'rb') as fp:
+        index = TreeIndex.scan(fp)
+        assert index.is_nexus
+        assert len(index) == 10
+        assert len(index.translate) == 26
+        assert index.burnin_cutoff(20) == 2
+        trees = list(index.tree_strings(fp, 2, step=3))
+        assert len(trees) == 3
+        assert all(t.startswith('(') and t.endswith(';') for t in trees)
+
+    with open(treefilepath('basic.trees'), 'rb') as fp:
+        index = TreeIndex.scan(fp)
+        assert not index.is_nexus
+        assert len(index) == 6
+        assert list(index.tree_strings(fp, 5)) == ['(((A,B),F),(D,(E,C)));']
+
+
+def test_ComplexNewickParser_indexed_burnin(treefilepath, mocker):
+    # Burn in on a regular file seeks through a byte index instead of
+    # copying all trees to a temp file.
+    spy = mocker.spy(tempfile, 'NamedTemporaryFile')
+    fileinput._state = None
+    with open(treefilepath('beast_output.nex')) as fp:
+        trees = list(ComplexNewickParser(burnin=20, subsample=3).consume(fp))
+    assert len(trees) == 3
+    assert len(trees[0].get_leaves()) == 26
+    assert spy.call_count == 0
+
+
+def test_MappedFileInput(treefilepath, tmpdir):
+    empty = tmpdir.join('empty.trees')
+    empty.write('')
+    fnames = [treefilepath('basic.trees'), str(empty), treefilepath('beast_output.nex')]
+    with closing(fileinput.input(fnames)) as fp:
+        expected = list(fp)
+    mapped = MappedFileInput(fnames)
+    assert list(mapped) == expected
+    mapped.close()
+
+    mapped = MappedFileInput(fnames)
+    first_lines = [line for line in mapped if mapped.isfirstline()]
+    assert first_lines == ['(((A,B),C),(D,(E,F)));\n', '#NEXUS\n']
+
+
+def test_MappedFileInput_text_stdin(treefilepath, monkeypatch, capsys):
+    # A text stdin without a binary buffer, as when phyltr is embedded
+    with open(treefilepath('beast_output.nex')) as fp:
+        text = fp.read()
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(text))
+    assert list(MappedFileInput(['-'])) == text.splitlines(True)
+    expected = [t.write() for t in ComplexNewickParser(burnin=20).consume(
+        MappedFileInput([treefilepath('beast_output.nex')]))]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(text))
+    trees = ComplexNewickParser(burnin=20).consume(MappedFileInput(['-']))
+    assert [t.write() for t in trees] == expected
+
+    with open(treefilepath('basic.trees')) as fp:
+        monkeypatch.setattr(sys, 'stdin', io.StringIO(fp.read()))
+    run_command('taxa')
+    assert capsys.readouterr().out.split() == list('ABCDEF')
+
+
+@pytest.mark.parametrize('burnin,subsample', [(0, 1), (0, 3), (20, 1), (50, 2)])
+def test_ComplexNewickParser_mapped(treefilepath, burnin, subsample):
+    fnames = [treefilepath('beast_output.nex'), treefilepath('basic.trees')]
+    with closing(fileinput.input(fnames)) as fp:
+        expected = [t.write() for t in ComplexNewickParser(burnin, subsample).consume(fp)]
+    trees = ComplexNewickParser(burnin, subsample).consume(MappedFileInput(fnames))
+    assert [t.write() for t in trees] == expected
+
+
+@pytest.mark.parametrize('module', [gzip, bz2, lzma])
+@pytest.mark.parametrize('burnin,subsample', [(0, 1), (20, 2)])
+def test_ComplexNewickParser_compressed(
+        treefilepath, tmpdir, monkeypatch, module, burnin, subsample):
+    fnames = [treefilepath('beast_output.nex'), treefilepath('basic.trees')]
+    expected = [
+        t.write() for t in ComplexNewickParser(burnin, subsample).consume(MappedFileInput(fnames))]
+    compressed = []
+    for fname in fnames:
+        path = str(tmpdir.join(os.path.basename(fname) + '.z'))
+        with open(fname, 'rb') as src, module.open(path, 'wb') as dst:
+            dst.write(src.read())
+        compressed.append(path)
+    trees = ComplexNewickParser(burnin, subsample).consume(MappedFileInput(compressed))
+    assert [t.write() for t in trees] == expected
+
+    # Compressed stdin is decompressed too, and burnt in through a temp file
+    with open(compressed[0], 'rb') as fp:
+        monkeypatch.setattr(
+            sys, 'stdin', io.TextIOWrapper(io.BufferedReader(io.BytesIO(fp.read()))))
+    expected = [t.write() for t in ComplexNewickParser(burnin, subsample).consume(
+        MappedFileInput(fnames[:1]))]
+    trees = ComplexNewickParser(burnin, subsample).consume(MappedFileInput(['-']))
+    assert [t.write() for t in trees] == expected
+
+
+def test_flatten_tree():
+    t = read_newick("((A:1,B:2)0.5:1[&&NHX:x=1],(C,D)0.9);")
+    copy = unflatten_tree(flatten_tree(t))
+    assert copy.write(features=[]) == t.write(features=[])
+    assert copy.children[0].up is copy
+
+
+@pytest.mark.parametrize('backend', ['ete3', 'native'])
+def test_ComplexNewickParser_jobs(treefilepath, backend, monkeypatch):
+    # Use small batches so that trees are spread over several workers
+    monkeypatch.setattr('phyltr.plumbing.sources.BATCH_SIZE', 1)
+    fnames = [treefilepath('beast_output_rate_annotations.nex'), treefilepath('basic.trees')]
+    serial = ComplexNewickParser(burnin=10, backend=backend).consume(MappedFileInput(fnames))
+    parallel = ComplexNewickParser(burnin=10, backend=backend, jobs=2).consume(
+        MappedFileInput(fnames))
+    assert [t.write(features=[]) for t in parallel] == [t.write(features=[]) for t in serial]
+
+
+def test_LazyTree():
+    newick = '(A:1,(B:1,C:1)x:0.5);'
+    t = LazyTree(newick, lambda s: get_tree(s)[0])
+    assert t.verbatim() == newick
+    assert copy.deepcopy(t).verbatim() == newick
+    assert sorted(t.get_leaf_names()) == ['A', 'B', 'C']
+    assert t.verbatim() is None
+    assert all(c.up is t for c in t.children)
+    assert (t & 'B').up.name == 'x'
+
+    # Setting an attribute parses the tree first
+    t = LazyTree(newick, lambda s: get_tree(s)[0])
+    t.name = 'root'
+    assert t.name == 'root' and len(t) == 3
+
+
+def test_NewickFormatter_lazy():
+    parse = lambda s: get_tree(s)[0]
+    touched = LazyTree('(A,B);', parse)
+    touched.dist = 0.5
+    trees = [LazyTree('(A , B);', parse), touched, LazyTree('(A,B);', parse, verbatim=False)]
+    buf = StringIO()
+    NewickFormatter(out=buf).consume(trees)
+    assert buf.getvalue().splitlines() == ['(A , B);', '(A:1,B:1)1:0.5;', '(A:1,B:1)1:0;']
+
+
+def test_ComplexNewickParser_lazy(treefile):
+    trees = list(ComplexNewickParser(lazy=True).consume(treefile('basic.trees')))
+    assert all(t.verbatim() for t in trees)
+    trees = list(ComplexNewickParser(lazy=True).consume(treefile('beast_output.nex')))
+    assert not any(t.verbatim() for t in trees)
+    assert all(len(t.get_leaves()) == 26 for t in trees)
+    assert not any(n.name.isdigit() for n in trees[0].get_leaves())
+
+
+def test_binary_treestream(treefilepath):
+    trees = list(ComplexNewickParser().consume(
+        MappedFileInput([treefilepath('beast_output_geo_annotations.nex')])))
+    for n in trees[0].traverse():
+        n.add_features(count=3, weight=0.5, flag=None)
+    buf = io.BytesIO()
+    BinaryFormatter(buf).consume(trees)
+    buf.seek(0)
+    read = list(BinaryTreeReader().trees(buf))
+    assert [t.write(features=[]) for t in read] == [t.write(features=[]) for t in trees]
+    node = read[0].get_leaves()[0]
+    # Values other than numbers and strings are sent as strings
+    assert (node.count, node.weight, node.flag) == (3, 0.5, "None")
+
+
+def test_binary_treestream_rejects_pickles(basictrees, monkeypatch):
+    import pickle
+    from phyltr.plumbing import binary
+
+    for n in basictrees[0].traverse():
+        n.add_features(flag=None)
+    # What versions which pickled unknown values wrote for them
+    monkeypatch.setattr(
+        binary, '_encode_column', lambda values: (b"p", pickle.dumps(values)))
+    buf = io.BytesIO()
+    BinaryFormatter(buf).consume(basictrees[:1])
+    buf.seek(0)
+    with pytest.raises(ValueError):
+        list(BinaryTreeReader().trees(buf))
+
+
+@pytest.mark.parametrize('burnin,subsample', [(0, 1), (20, 3)])
+def test_binary_sources(treefilepath, tmpdir, burnin, subsample):
+    fnames = [treefilepath('beast_output.nex'), treefilepath('basic.trees')]
+    expected = [t.write() for t in ComplexNewickParser(burnin, subsample).consume(
+        MappedFileInput(fnames))]
+    binary = []
+    for fname in fnames:
+        path = str(tmpdir.join(os.path.basename(fname) + '.bin'))
+        with open(path, 'wb') as fp:
+            BinaryFormatter(fp).consume(ComplexNewickParser().consume(MappedFileInput([fname])))
+        binary.append(path)
+    trees = ComplexNewickParser(burnin, subsample).consume(MappedFileInput(binary))
+    assert [t.write() for t in trees] == expected
+    trees = ComplexNewickParser(burnin, subsample, jobs=2).consume(MappedFileInput(binary))
+    assert [t.write() for t in trees] == expected
+    if not burnin:
+        trees = NewickParser().consume(MappedFileInput(binary))
+        assert [t.write() for t in trees] == expected
+
+
+def test_use_binary(monkeypatch):
+    monkeypatch.delenv('PHYLTR_BINARY', raising=False)
+    read, write = os.pipe()
+    with os.fdopen(read) as r, os.fdopen(write, 'w') as w:
+        assert not use_binary(w)
+        monkeypatch.setenv('PHYLTR_BINARY', '1')
+        assert use_binary(w)
+        assert not use_binary(StringIO())
+
+
+def test_ComplexNewickParser_seeds_taxa(treefile):
+    p = ComplexNewickParser()
+    p.taxa = TaxonRegistry()
+    trees = list(p.consume(treefile('beast_output.nex')))
+    assert len(p.taxa) == 26
+    assert p.taxa.names[0] == p.nexus_trans['1']
+    assert sorted(p.taxa.leaf_ids(trees[0])) == list(range(26))
+
+
+@pytest.mark.parametrize('suffix,module', [('', io), ('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)])
+def test_OutputWriter(tmpdir, suffix, module):
+    filename = str(tmpdir.join('out.trees' + suffix))
+    with OutputWriter(filename) as out:
+        NewickFormatter(out).consume([Tree('(A:1,B:1);')] * 3)
+        StringFormatter(out).consume(['done'])
+    with module.open(filename, 'rt') as fp:
+        assert fp.read() == '(A:1,B:1)1:0;\n' * 3 + 'done\n'
+
+
+def test_OutputWriter_error(tmpdir):
+    out = OutputWriter(str(tmpdir.join('out.trees')))
+    out.fp.close()
+    out.write('lost')
+    # Errors of the writer thread are raised in the thread writing to it
+    with pytest.raises(ValueError):
+        out.flush()
+    out.close()
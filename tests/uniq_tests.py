@@ -32,3 +32,8 @@ def test_min_med_max_uniq(basictrees):
 
     for l, m, L in zip(min_lengths, med_lengths, max_lengths):
         assert l <= m <= L
+
+def test_uniq_duplicate_taxa(treefilenewick):
+    trees = treefilenewick('monophyletic_dupe_taxa.trees')
+    topologies = set(t.get_topology_id() for t in trees)
+    assert sum(1 for t in Uniq().consume(trees)) == len(topologies)
@@ -1,11 +1,14 @@
 from collections import namedtuple
 import argparse
+import json
+import pickle
 
 import pytest
 
 from phyltr.utils import misc
 from phyltr.utils import cladeprob
 from phyltr.utils import phyltroptparse
+from phyltr.utils import topouniq
 
 
 @pytest.mark.parametrize(
@@ -43,3 +46,202 @@ def test_default():
 
     assert getattr(A(), 'b', misc.DEFAULT) == None
     assert getattr(A(), 'c', misc.DEFAULT) != None
+
+
+def test_TaxonRegistry():
+    from ete3 import Tree
+    from phyltr.utils.taxonregistry import TaxonRegistry
+
+    registry = TaxonRegistry()
+    registry.seed({'1': 'C', '2': 'A'})
+    t1, t2 = Tree('((A,B),C);'), Tree('((C,B),A);')
+    assert registry.leaf_ids(t1) == [1, 2, 0]
+    assert registry.leaf_ids(t2) == [0, 2, 1]
+    assert len(registry) == 3 and 'B' in registry
+    # Leaf names are interned
+    assert (t1 & 'B').name is (t2 & 'B').name
+    # Renaming a leaf gives it the new taxon's id
+    leaf = t1 & 'A'
+    leaf.name = 'D'
+    assert registry.leaf_id(leaf) == 3
+    assert registry.taxon_ids(['D', 'C']) == {3, 0}
+
+
+def test_FeatureSchema():
+    from ete3 import Tree
+    from phyltr.utils.featureschema import FeatureSchema
+
+    schema = FeatureSchema(['b', 'name'])
+    assert list(schema) == ['b'] and 'name' not in schema
+    t = Tree('(A[&&NHX:c=1],B[&&NHX:a=2]);')
+    schema.add_tree(t)
+    assert schema.names == ['a', 'b', 'c'] and len(schema) == 3
+
+
+def test_clade_masks():
+    from ete3 import Tree
+
+    t = Tree('((A,B),(C,(D,E)));')
+    masks = cladeprob.clade_masks(t)
+    assert masks[t] == cladeprob.clade_mask('ABCDE')
+    assert cladeprob.clade_names(masks[(t & 'A').up]) == ['A', 'B']
+    assert sorted(cladeprob.clade_names(masks[n]) for n in t.children) == [
+        ['A', 'B'], ['C', 'D', 'E']]
+
+
+def test_tree_clades():
+    from ete3 import Tree
+
+    t = Tree('((A:1,B:2):1,(C:0.5,(D:1,E:1):3):2);')
+    nodes, masks, heights, depths = cladeprob.tree_clades(t)
+    assert nodes == list(t.traverse())
+    for node, height, depth in zip(nodes, heights, depths):
+        assert height == pytest.approx(node.get_farthest_leaf()[1])
+        assert depth == pytest.approx(t.get_distance(node))
+
+
+@pytest.mark.parametrize(
+    'newick1,newick2',
+    [
+        ('((A,B),(C,D));', '((D,C),(B,A));'),
+        ('((A,B),C,D);', '(((A,B),C),D);'),
+        ('(((A)),B);', '((A),B);'),
+        ('((A,B),(C,D));', '(A,(B,(C,D)));'),
+        ('((A,B),C);', '((A,B),D);'),
+    ]
+)
+def test_topology_key(newick1, newick2):
+    from ete3 import Tree
+
+    t1, t2 = Tree(newick1), Tree(newick2)
+    assert (topouniq.topology_key(t1) == topouniq.topology_key(t2)) == \
+        (t1.get_topology_id() == t2.get_topology_id())
+    assert topouniq.are_same_topology(t1, t2) == (t1.get_topology_id() == t2.get_topology_id())
+
+
+def test_CladeProbabilities_caches():
+    import gc
+    from ete3 import Tree
+
+    cp = cladeprob.CladeProbabilities()
+    t = Tree('((A:1,B:1):1,((C:1,D:1):1,E:1):1);')
+    cp.add_tree(t)
+    cp.compute_probabilities()
+    assert [cladeprob.clade_names(c) for _, c in cp.internal_clades(t)] == [
+        ['A', 'B', 'C', 'D', 'E'], ['A', 'B'], ['C', 'D', 'E'], ['C', 'D']]
+    # Trees which have changed shape have their clades computed again
+    (t & 'C').up.delete()
+    assert [cladeprob.clade_names(c) for _, c in cp.internal_clades(t)] == [
+        ['A', 'B', 'C', 'D', 'E'], ['A', 'B'], ['C', 'D', 'E']]
+    # Even if they still have as many internal nodes, here with (D) left
+    # above a single leaf
+    t = Tree('((A:1,B:1):1,((C:1,D:1):1,E:1):1);')
+    cp.add_tree(t)
+    c = t & 'C'
+    (t & 'A').up.add_child(c.detach())
+    assert [cladeprob.clade_names(c) for _, c in cp.internal_clades(t)] == [
+        ['A', 'B', 'C', 'D', 'E'], ['A', 'B', 'C'], ['D', 'E']]
+    (t & 'A').name = 'F'
+    assert [cladeprob.clade_names(c) for _, c in cp.internal_clades(t)][1] == ['B', 'C', 'F']
+    # Remembering the clades of a tree does not keep it alive
+    del t, c
+    gc.collect()
+    assert not cp.caches
+
+
+def test_Summary():
+    import random
+    import statistics
+    from phyltr.utils.summary import Summary
+
+    rng = random.Random(1)
+    values = [rng.lognormvariate(0, 2) - 1 for _ in range(2001)] + [0.0]
+    summary, first, second = Summary(0.01), Summary(0.01), Summary(0.01)
+    for i, value in enumerate(values):
+        summary.append(value)
+        (first if i % 3 else second).append(value)
+    first.merge(second)
+    values.sort()
+    for s in (summary, first):
+        assert len(s) == len(values)
+        assert (s.min, s.max) == (values[0], values[-1])
+        assert s.mean() == pytest.approx(statistics.mean(values))
+        assert s.stdev() == pytest.approx(statistics.stdev(values))
+        assert s.median() == pytest.approx(statistics.median(values), rel=0.01)
+        assert s.statistic('median') == s.median()
+        for q in (0.025, 0.3, 0.975):
+            assert s.quantile(q) == pytest.approx(values[int(q * len(values))], rel=0.01)
+
+    with pytest.raises(ValueError):
+        Summary(0.02).merge(summary)
+    with pytest.raises(ValueError):
+        Summary(0)
+
+    restored = Summary.from_json(json.loads(json.dumps(summary.to_json())))
+    assert restored.to_json() == summary.to_json()
+    assert restored.quantile(0.3) == summary.quantile(0.3)
+    with pytest.raises(ValueError):
+        Summary.from_json({"error": 0.01})
+
+
+def test_add_mean_median_hpd():
+    from ete3 import Tree
+    from phyltr.utils.summary import Summary
+
+    values = [float(x) for x in range(1, 101)]
+    summary = Summary(0.001)
+    for value in values:
+        summary.append(value)
+    exact, approximate = Tree(), Tree()
+    cladeprob.add_mean_median_hpd(exact, values, 'age_', precision=1)
+    cladeprob.add_mean_median_hpd(approximate, summary, 'age_', precision=1)
+    for feature in ('min', 'max', 'mean', 'median', 'stdev', 'HPD'):
+        assert getattr(exact, 'age_' + feature) == getattr(approximate, 'age_' + feature)
+
+
+def test_CladeProbabilities_table(tmpdir, monkeypatch):
+    from ete3 import Tree
+    from phyltr.utils.taxonregistry import TaxonRegistry
+
+    cp = cladeprob.CladeProbabilities(summary_error=0.01)
+    for newick in ('((A:1,B:1):1,C:2);', '((A:1,C:1):2,B:3);'):
+        cp.add_tree(Tree(newick))
+    other = cladeprob.CladeProbabilities(summary_error=0.01)
+    other.add_tree(Tree('((A:1,B:1):3,C:4);'))
+    cp.merge(other)
+    assert cp.tree_count == 3 and cp.clade_counts[cladeprob.clade_mask('AB')] == 2
+    assert cp.clade_ages[cladeprob.clade_mask('ABC')].max == 4
+    with pytest.raises(ValueError):
+        cp.merge(cladeprob.CladeProbabilities())
+
+    filename = str(tmpdir.join('clades.table'))
+    cp.save_table(filename)
+    # Loading a table in a process which numbers the taxa differently
+    monkeypatch.setattr(cladeprob, 'REGISTRY', TaxonRegistry())
+    cladeprob.REGISTRY.seed({1: 'C', 2: 'B', 3: 'A'})
+    loaded = cladeprob.CladeProbabilities.load_table(filename)
+    assert loaded.tree_count == 3
+    assert sorted((cladeprob.clade_names(c), n) for c, n in loaded.clade_counts.items()) == [
+        (['A', 'B'], 2), (['A', 'B', 'C'], 3), (['A', 'C'], 1)]
+    assert loaded.clade_ages[cladeprob.clade_mask('ABC')].max == 4
+    assert loaded.leaf_heights['B'].count == 3
+
+    # Other files are not mistaken for tables
+    with pytest.raises(ValueError):
+        cladeprob.CladeProbabilities.load_table(__file__)
+
+    # Tables are never unpickled, and only hold numbers, names and clades
+    with open(filename, 'rb') as fp:
+        table = json.loads(fp.read()[len(cladeprob.TABLE_MAGIC):].decode('utf-8'))
+    bad_tables = [
+        pickle.dumps(cp.to_table()),
+        json.dumps(dict(table, clade_counts=[[-1, 1]])).encode('utf-8'),
+        json.dumps(dict(table, clade_counts=[[1 << len(table['taxa']), 1]])).encode('utf-8'),
+        json.dumps(dict(table, leaf_heights=[['?', table['leaf_heights'][0][1]]])).encode('utf-8'),
+        json.dumps(dict(table, clade_ages=[[7, [1.0]]])).encode('utf-8'),
+    ]
+    for data in bad_tables:
+        with open(filename, 'wb') as fp:
+            fp.write(cladeprob.TABLE_MAGIC + data)
+        with pytest.raises(ValueError):
+            cladeprob.CladeProbabilities.load_table(filename)